@@ -1,12 +1,19 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import bisect
 import collections
 import datetime
+import hashlib
 import json
+import os
+import shutil
+import struct
 import sys
 import pygit2
 
+import lib
+
 
 Transaction = collections.namedtuple('Transaction', ('payload', 'blob_id', 'commit_id', 'commit_time', 'prev_commit_time'))
 
@@ -22,9 +29,42 @@ def _is_blob(o):
     return o.type in (pygit2.GIT_OBJ_BLOB, 'blob')
 
 
+def _blob_entries(repo, tree_id, seen, key):
+    """The blobs in a category tree, in the flat or the sharded layout.
+
+    In the sharded layout the blobs are one level down, in subtrees
+    named after a hash of the file name. Either way the transaction
+    is known by the file name, so a move between layouts is not
+    a new version.
+
+    seen remembers the tree ids from the previous commit, by key, so
+    that trees (whole categories, or shards) which have not changed
+    since then are skipped: everything in them has been seen already.
+    """
+    if seen.get(key) == tree_id:
+        return
+    seen[key] = tree_id
+    for entry in repo[tree_id]:
+        if _is_tree(entry):
+            shard_key = key + (entry.name,)
+            if seen.get(shard_key) == entry.id:
+                continue
+            seen[shard_key] = entry.id
+            for entry2 in repo[entry.id]:
+                if not _is_blob(entry2):
+                    print('Warning: non-blob', entry2.id, 'at shard level', file=sys.stderr)
+                    continue
+                yield entry2
+        elif _is_blob(entry):
+            yield entry
+        else:
+            print('Warning: non-blob', entry.id, 'at category level', file=sys.stderr)
+
+
 def read_repo(path, has_categories=False):
     accounts = {}
     have_transactions = set()
+    seen_trees = {}
     repo = pygit2.Repository(path)
     prev_time = datetime.datetime(2000, 1, 1)
     for commit in repo.walk(repo.head.target, pygit2.GIT_SORT_TOPOLOGICAL|pygit2.GIT_SORT_REVERSE):
@@ -48,10 +88,7 @@ def read_repo(path, has_categories=False):
                 categories = [(None, entry1.id)]
             for category_name, category_id in categories:
                 category = account.setdefault(category_name, {})
-                for entry3 in repo[category_id]:
-                    if not _is_blob(entry3):
-                        print('Warning: non-blob', entry3.id, 'at category level', file=sys.stderr)
-                        continue
+                for entry3 in _blob_entries(repo, category_id, seen_trees, (entry1.name, category_name)):
                     transaction = category.setdefault(entry3.name, [])
                     if transaction and transaction[-1].blob_id == entry3.id:
                         continue
@@ -65,3 +102,256 @@ def read_repo(path, has_categories=False):
                     ))
         prev_time = cur_time
     return accounts
+
+
+class History(object):
+    """Point-in-time view of a repo: what the bank said as of some commit.
+
+    Built once from read_repo's output. Each version of a transaction is
+    valid from the commit where it appeared until the next version, so
+    finding the version current at a given commit is a binary search in
+    that transaction's versions. Balances are kept as running totals per
+    commit, so a balance as of any commit is a single binary search.
+
+    amount(payload) gives the (currency, signed minor units) that a
+    transaction contributes to the balance, or None; see amount() in
+    starling/audit.py and monzo/audit.py.
+
+    Transactions that vanish from the bank's feed are not noticed by
+    read_repo, so they remain in every later state too.
+    """
+
+    def __init__(self, path, has_categories=False, amount=None):
+        repo = pygit2.Repository(path)
+        self.commit_ids = []
+        self.commit_times = []
+        for commit in repo.walk(repo.head.target, pygit2.GIT_SORT_TOPOLOGICAL|pygit2.GIT_SORT_REVERSE):
+            self.commit_ids.append(commit.id)
+            self.commit_times.append(datetime.datetime.utcfromtimestamp(commit.commit_time))
+        self.commit_seq = dict((commit_id, seq) for seq, commit_id in enumerate(self.commit_ids))
+        self.accounts = read_repo(path, has_categories)
+
+        # For each transaction, the commit sequence numbers of its versions.
+        self.version_seqs = {}
+        # For each (account, category, currency), parallel lists of commit
+        # sequence numbers and the balance after that commit.
+        self.balances = {}
+        for account_name, account in self.accounts.items():
+            for category_name, category in account.items():
+                deltas = collections.defaultdict(lambda: collections.defaultdict(int))
+                for name, versions in category.items():
+                    seqs = [self.commit_seq[v.commit_id] for v in versions]
+                    self.version_seqs[(account_name, category_name, name)] = seqs
+                    if amount is None:
+                        continue
+                    prev = None
+                    for seq, version in zip(seqs, versions):
+                        cur = amount(version.payload)
+                        if prev is not None:
+                            deltas[prev[0]][seq] -= prev[1]
+                        if cur is not None:
+                            deltas[cur[0]][seq] += cur[1]
+                        prev = cur
+                for currency, by_seq in deltas.items():
+                    seqs = sorted(by_seq)
+                    totals = []
+                    total = 0
+                    for seq in seqs:
+                        total += by_seq[seq]
+                        totals.append(total)
+                    self.balances[(account_name, category_name, currency)] = (seqs, totals)
+
+    def commit_at(self, when):
+        """Sequence number of the commit as of <when>, or -1 if before any.
+
+        <when> is a commit id (as a string or Oid) or a datetime (UTC),
+        in which case it is the last commit at or before that time.
+        """
+        if isinstance(when, datetime.datetime):
+            return bisect.bisect_right(self.commit_times, when) - 1
+        if not isinstance(when, pygit2.Oid):
+            when = pygit2.Oid(hex=str(when))
+        return self.commit_seq[when]
+
+    def transactions_as_of(self, when):
+        """{account: {category: {name: Transaction}}} as of <when>."""
+        seq = self.commit_at(when)
+        result = {}
+        for (account_name, category_name, name), seqs in self.version_seqs.items():
+            i = bisect.bisect_right(seqs, seq) - 1
+            if i < 0:
+                continue
+            version = self.accounts[account_name][category_name][name][i]
+            result.setdefault(account_name, {}).setdefault(category_name, {})[name] = version
+        return result
+
+    def balances_as_of(self, when):
+        """{account: {category: {currency: minor units}}} as of <when>."""
+        seq = self.commit_at(when)
+        result = {}
+        for (account_name, category_name, currency), (seqs, totals) in self.balances.items():
+            i = bisect.bisect_right(seqs, seq) - 1
+            if i < 0:
+                continue
+            result.setdefault(account_name, {}).setdefault(category_name, {})[currency] = totals[i]
+        return result
+
+
+# The first-seen index: one file per account (or account/category)
+# directory, at <git dir>/bank-first-seen/<directory>, for the Dovecot
+# plugin to mmap. See update_first_seen_index().
+FIRST_SEEN_DIR = 'bank-first-seen'
+FIRST_SEEN_MAGIC = b'BKFS'
+FIRST_SEEN_VERSION = 1
+_FIRST_SEEN_HEADER = struct.Struct('>4sII')  # magic, version, count
+_FIRST_SEEN_ENTRY = struct.Struct('>20s20sq')  # blob id, commit id, commit time
+
+
+def mailbox_dir(path):
+    """The account or account/category directory of a file, whatever the layout."""
+    parts = path.split('/')
+    if len(parts) > 2 and parts[-2] == hashlib.sha1(parts[-1].encode('utf-8')).hexdigest()[:2]:
+        del parts[-2]
+    return '/'.join(parts[:-1])
+
+
+def read_first_seen(filename):
+    """{blob id: (commit id, commit time)} from a first-seen index file, as raw bytes."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, count = _FIRST_SEEN_HEADER.unpack_from(data)
+    if magic != FIRST_SEEN_MAGIC or version != FIRST_SEEN_VERSION:
+        raise ValueError('%s is not a version %d first-seen index' % (filename, FIRST_SEEN_VERSION))
+    entries = {}
+    for offset in range(_FIRST_SEEN_HEADER.size, _FIRST_SEEN_HEADER.size + count * _FIRST_SEEN_ENTRY.size,
+                        _FIRST_SEEN_ENTRY.size):
+        blob_id, commit_id, commit_time = _FIRST_SEEN_ENTRY.unpack_from(data, offset)
+        entries[blob_id] = (commit_id, commit_time)
+    return entries
+
+
+def write_first_seen(filename, entries):
+    """Write a first-seen index file, sorted by blob id, atomically."""
+    with lib.atomic_write(filename, 'wb') as f:
+        f.write(_FIRST_SEEN_HEADER.pack(FIRST_SEEN_MAGIC, FIRST_SEEN_VERSION, len(entries)))
+        for blob_id in sorted(entries):
+            commit_id, commit_time = entries[blob_id]
+            f.write(_FIRST_SEEN_ENTRY.pack(blob_id, commit_id, commit_time))
+
+
+def new_commits(repo, since=None):
+    """(head, commits, rewritten) for the commits after <since>, oldest first.
+
+    since is the head from last time (a commit id), or None for the whole
+    history. If history was rewritten so that since is no longer an
+    ancestor of head, commits is the whole history and rewritten is True:
+    whatever was built from the old history should be thrown away first.
+    """
+    head = repo.head.target
+    walker = repo.walk(head, pygit2.GIT_SORT_TOPOLOGICAL|pygit2.GIT_SORT_REVERSE)
+    if since is None:
+        return head, walker, False
+    since = pygit2.Oid(hex=str(since))
+    if since != head and not repo.descendant_of(head, since):
+        return head, walker, True
+    walker.hide(since)
+    return head, walker, False
+
+
+def changed_files(repo, commit):
+    """(path, old blob id or None, new blob id) for each file the commit adds or changes.
+
+    Changes are against the first parent, so a merge shows what it brought in.
+    """
+    if commit.parents:
+        diff = repo.diff(commit.parents[0].tree, commit.tree)
+    else:
+        diff = commit.tree.diff_to_tree(swap=True)
+    for delta in diff.deltas:
+        if delta.status == pygit2.GIT_DELTA_DELETED:
+            continue
+        old_id = delta.old_file.id if delta.status == pygit2.GIT_DELTA_MODIFIED else None
+        yield delta.new_file.path, old_id, delta.new_file.id
+
+
+def update_first_seen_index(path):
+    """Bring the first-seen index files in the git dir up to date.
+
+    Each file lists every version of every transaction that has been in
+    its directory, by blob id, with the id and time of the commit where
+    the transaction first appeared: the same least recent commit that
+    read_repo gives as the first version's commit_id, and that the
+    Dovecot plugin would otherwise find by walking back through history.
+
+    HEAD in the index directory records the commit the files are up to
+    date with, so only the commits since then are looked at, and only
+    the files for directories they touched are rewritten. Returns how
+    many commits were looked at.
+    """
+    repo = pygit2.Repository(path)
+    index_dir = os.path.join(repo.path, FIRST_SEEN_DIR)
+    head_file = os.path.join(index_dir, 'HEAD')
+    try:
+        with open(head_file) as f:
+            old_head = f.read().strip()
+    except IOError:
+        old_head = None
+    head, commits, rewritten = new_commits(repo, old_head)
+
+    indexes = {}
+    if old_head is not None and not rewritten:
+        for dirpath, dirnames, filenames in os.walk(index_dir):
+            for filename in filenames:
+                if (dirpath == index_dir and filename == 'HEAD') or '.new.' in filename:
+                    continue
+                filename = os.path.join(dirpath, filename)
+                indexes[os.path.relpath(filename, index_dir)] = read_first_seen(filename)
+    elif os.path.isdir(index_dir):
+        # History was rewritten (or the index is incomplete); start again.
+        shutil.rmtree(index_dir)
+
+    changed = set()
+    n = 0
+    for commit in commits:
+        first_seen = (commit.id.raw, commit.commit_time)
+        for file_path, old_id, new_id in changed_files(repo, commit):
+            directory = mailbox_dir(file_path)
+            if not directory:
+                continue
+            entries = indexes.setdefault(directory, {})
+            if new_id.raw in entries:
+                # Not a new version, just moved (to or from the sharded layout).
+                continue
+            if old_id is not None and old_id.raw in entries:
+                entries[new_id.raw] = entries[old_id.raw]
+            else:
+                entries[new_id.raw] = first_seen
+            changed.add(directory)
+        n += 1
+
+    for directory in changed:
+        filename = os.path.join(index_dir, directory)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        write_first_seen(filename, indexes[directory])
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    with lib.atomic_write(head_file) as f:
+        f.write(str(head) + '\n')
+    return n
+
+
+def main():
+    """Update the first-seen index of each repo named on the command line.
+
+    Suitable for a post-receive hook in the repo that fetches push to
+    (with argument "."), so the index is refreshed after each fetch.
+    """
+    if len(sys.argv) < 2:
+        raise RuntimeError('Usage: %s REPO...' % sys.argv[0])
+    for path in sys.argv[1:]:
+        update_first_seen_index(path)
+
+
+if __name__ == '__main__':
+    main()
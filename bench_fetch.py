@@ -0,0 +1,190 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Benchmark full fetch runs against the mock bank API server.
+
+For each history size, starts a mockbank server, makes scratch project
+directories (with a bare repo as origin) and runs each bank's fetcher
+against it: a first run that downloads the whole history, then some
+routine runs after the history has moved on a little. Then times
+walking the history with bankrepo.read_repo, before and after repo
+maintenance (which is kept out of the fetch runs being timed).
+
+The mock server can be made to fail some requests, to see what the
+retries cost: --error-rate, --error-status, --retry-after and
+--drop-rate are passed on to mockbank.make_server().
+
+Usage: bench_fetch.py [--latency=seconds] [--runs=n]
+                      [--error-rate=fraction] [--error-status=status]
+                      [--retry-after=seconds] [--drop-rate=fraction]
+                      [bank...] [size...]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import bankrepo
+import fetch_base
+import mockbank
+
+
+BANKS = ('starling', 'monzo', 'wise')
+HAS_CATEGORIES = {'starling': True, 'monzo': False, 'wise': True}
+SIZES = (100, 1000, 10000)
+
+# Between routine runs, this many transactions change and this many appear.
+UPDATED_PER_RUN = 5
+ADDED_PER_RUN = 5
+
+
+def _local(api_class, server, **attrs):
+    """Subclass api_class to talk to server without any credentials."""
+    attrs.update({
+        'HOSTNAME': '127.0.0.1',
+        'PORT': server.server_port,
+        'HTTPS': False,
+        'RATE': 1e6,
+        'BURST': 1e6,
+        'token': 'mock-token',
+        '__init__': lambda self: None,
+    })
+    return type('Local' + api_class.__name__, (api_class,), attrs)()
+
+
+def bank_runner(bank, server):
+    """A function running one fetch of <bank> into a project dir."""
+    if bank == 'starling':
+        import starling.fetch
+        api = _local(starling.fetch.StarlingAPI, server)
+        return lambda project_dir: starling.fetch.run(api, project_dir=project_dir)
+    if bank == 'monzo':
+        import monzo.fetch
+        api = _local(monzo.fetch.MonzoAPI, server)
+        return lambda project_dir: monzo.fetch.run(api, project_dir=project_dir)
+    if bank == 'wise':
+        import wise.fetch
+        api = _local(
+            wise.fetch.WiseAPI, server,
+            profile=mockbank.WISE_PROFILE, sign_2fa=lambda self, message: 'mock-signature')
+        return lambda project_dir: wise.fetch.run(api, project_dir=project_dir)
+    raise RuntimeError('Unknown bank ' + bank)
+
+
+def make_project(parent, bank):
+    project_dir = os.path.join(parent, bank)
+    work = os.path.join(project_dir, 'work')
+    origin = os.path.join(project_dir, 'origin.git')
+    subprocess.check_call(('git', 'init', '-q', '--bare', origin))
+    subprocess.check_call(('git', 'init', '-q', work))
+    for args in (
+        ('remote', 'add', 'origin', origin),
+        ('config', 'user.name', 'Benchmark'),
+        ('config', 'user.email', 'benchmark@localhost'),
+    ):
+        subprocess.check_call(('git', '-C', work) + args)
+    return project_dir
+
+
+def timed_run(run, project_dir):
+    start = time.time()
+    run(project_dir)
+    elapsed = time.time() - start
+    values = dict((name, v) for (name, labels), v in fetch_base.metrics.values.items()
+                  if not labels)
+    items = sum(v for (name, labels), v in fetch_base.metrics.values.items()
+                if name == 'bank_fetch_items_received')
+    nbytes = sum(v for (name, labels), v in fetch_base.metrics.values.items()
+                 if name == 'bank_fetch_response_bytes')
+    retries = sum(v for (name, labels), v in fetch_base.metrics.values.items()
+                  if name == 'bank_fetch_retries')
+    return elapsed, items, nbytes, retries, values
+
+
+def report(bank, size, kind, result):
+    elapsed, items, nbytes, retries, values = result
+    print('%-8s %6d  %-7s %7.3fs  %6d items %9d bytes  %8.1f items/s  %3d retries  commit %.3fs' % (
+        bank, size, kind, elapsed, items, nbytes,
+        items / elapsed if elapsed else 0,
+        retries,
+        values.get('bank_fetch_commit_seconds', 0)))
+
+
+def timed_walk(bank, project_dir):
+    work = os.path.join(project_dir, 'work')
+    start = time.time()
+    bankrepo.read_repo(work, HAS_CATEGORIES[bank])
+    walk = time.time() - start
+    loose, packs = fetch_base.object_counts(work)
+    return walk, loose, packs
+
+
+def report_walk(bank, size, kind, result):
+    walk, loose, packs = result
+    print('%-8s %6d  %-7s %7.3fs  read_repo, %d loose objects, %d packs' % (
+        bank, size, kind, walk, loose, packs))
+
+
+def bench(bank, size, latency, runs, failures):
+    mock = mockbank.MockBank(size)
+    server = mockbank.make_server(mock, latency=latency, **failures)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    scratch = tempfile.mkdtemp(prefix='bench_fetch.')
+    cwd = os.getcwd()
+    try:
+        run = bank_runner(bank, server)
+        project_dir = make_project(scratch, bank)
+        report(bank, size, 'full', timed_run(run, project_dir))
+        for i in range(runs):
+            mock.advance(UPDATED_PER_RUN, ADDED_PER_RUN)
+            report(bank, size, 'routine', timed_run(run, project_dir))
+        report_walk(bank, size, 'walk', timed_walk(bank, project_dir))
+        start = time.time()
+        fetch_base.maintain_repo(os.path.join(project_dir, 'work'), full=True)
+        print('%-8s %6d  %-7s %7.3fs' % (bank, size, 'maint', time.time() - start))
+        report_walk(bank, size, 'walk', timed_walk(bank, project_dir))
+    finally:
+        os.chdir(cwd)
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(scratch)
+
+
+def main():
+    latency = 0.0
+    runs = 3
+    failures = {}
+    banks = []
+    sizes = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--latency='):
+            latency = float(arg.split('=', 1)[1])
+        elif arg.startswith('--runs='):
+            runs = int(arg.split('=', 1)[1])
+        elif arg.startswith('--error-rate='):
+            failures['error_rate'] = float(arg.split('=', 1)[1])
+        elif arg.startswith('--error-status='):
+            failures['error_status'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--retry-after='):
+            failures['retry_after'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--drop-rate='):
+            failures['drop_rate'] = float(arg.split('=', 1)[1])
+        elif arg.isdigit():
+            sizes.append(int(arg))
+        else:
+            banks.append(arg)
+    # Only maintain the repos between the timed walks.
+    fetch_base.MAINTENANCE_LOOSE_OBJECTS = fetch_base.MAINTENANCE_PACKS = float('inf')
+    for bank in banks or BANKS:
+        for size in sizes or SIZES:
+            bench(bank, size, latency, runs, failures)
+
+
+if __name__ == '__main__':
+    main()
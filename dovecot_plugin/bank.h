@@ -11,6 +11,7 @@ struct bank_mailbox {
 
 	git_repository *repo;
 	const char *dirpath;
+	struct first_seen_index *first_seen;
 };
 
 struct bank_mail_index_header {
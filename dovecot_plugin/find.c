@@ -20,6 +20,22 @@ find_blob(const char *root, const git_tree_entry *entry, void *payload)
 	return 0;
 }
 
+/* If path is in the sharded layout (.../<2 hex digits>/<name>), the
+   same path in the flat layout, for commits before the layout changed.
+   Otherwise NULL. */
+static const char *
+flat_path(const char *path)
+{
+	const char *name, *shard;
+
+	name = strrchr(path, '/');
+	if (name == NULL || name - path < 3) return NULL;
+	shard = name - 2;
+	if (!i_isxdigit(shard[0]) || !i_isxdigit(shard[1])) return NULL;
+	if (shard != path && shard[-1] != '/') return NULL;
+	return t_strdup_printf("%s%s", t_strdup_until(path, shard), name + 1);
+}
+
 int
 find_versions(git_repository *repo, const git_oid *blobid, find_versions_callback_t cb, void *data)
 {
@@ -30,6 +46,7 @@ find_versions(git_repository *repo, const git_oid *blobid, find_versions_callbac
 	git_tree *tree;
 	git_tree_entry *tentry;
 	struct find_blob_ctx fb_ctx;
+	const char *old_path;
 	git_revwalk *walk;
 	int ret;
 
@@ -58,6 +75,7 @@ find_versions(git_repository *repo, const git_oid *blobid, find_versions_callbac
 	}
 	git_commit_free(head_commit);
 	head_commit = NULL;
+	old_path = flat_path(fb_ctx.path);
 
 	/* Backtrack from head */
 
@@ -83,7 +101,10 @@ revwalk_error:
 			git_commit_free(commit);
 			goto revwalk_error;
 		}
-		if (git_tree_entry_bypath(&tentry, tree, fb_ctx.path) < 0) {
+		if (
+			(git_tree_entry_bypath(&tentry, tree, fb_ctx.path) < 0) &&
+			((old_path == NULL) || (git_tree_entry_bypath(&tentry, tree, old_path) < 0))
+		) {
 			ret = cb(commit, NULL, data);
 		} else {
 			ret = cb(commit, git_tree_entry_id(tentry), data);
@@ -0,0 +1,130 @@
+#include <errno.h>
+#include <fcntl.h>
+#include <stdint.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <git2.h>
+#include "lib.h"
+
+#include "firstseen.h"
+
+/* File format, all integers big-endian:
+     "BKFS", uint32 version, uint32 count,
+     then count entries sorted by blob id:
+       blob id (20 bytes), commit id (20 bytes), int64 commit time */
+
+#define FIRST_SEEN_DIR "bank-first-seen/"
+#define FIRST_SEEN_MAGIC "BKFS"
+#define FIRST_SEEN_VERSION 1
+#define HEADER_SIZE 12
+#define ENTRY_SIZE (2 * GIT_OID_RAWSZ + 8)
+
+struct first_seen_index {
+	void *map;
+	size_t size;
+	uint32_t count;
+	const unsigned char *entries;
+};
+
+static uint32_t
+get_be32(const unsigned char *p)
+{
+	return ((uint32_t)p[0] << 24) | ((uint32_t)p[1] << 16) | ((uint32_t)p[2] << 8) | p[3];
+}
+
+static int64_t
+get_be64(const unsigned char *p)
+{
+	return (int64_t)(((uint64_t)get_be32(p) << 32) | get_be32(p + 4));
+}
+
+struct first_seen_index *
+first_seen_open(git_repository *repo, const char *dir_path)
+{
+	struct first_seen_index *index;
+	const char *filename;
+	const unsigned char *header;
+	struct stat sbuf;
+	void *map;
+	int fd;
+
+	filename = t_strconcat(git_repository_path(repo), FIRST_SEEN_DIR, dir_path, NULL);
+	fd = open(filename, O_RDONLY);
+	if (fd < 0) {
+		if (errno != ENOENT) i_error("open(%s) failed: %m", filename);
+		return NULL;
+	}
+	if (fstat(fd, &sbuf) < 0) {
+		i_error("fstat(%s) failed: %m", filename);
+		i_close_fd(&fd);
+		return NULL;
+	}
+	if (sbuf.st_size < HEADER_SIZE) {
+		i_warning("%s: truncated", filename);
+		i_close_fd(&fd);
+		return NULL;
+	}
+	map = mmap(NULL, sbuf.st_size, PROT_READ, MAP_SHARED, fd, 0);
+	i_close_fd(&fd);
+	if (map == MAP_FAILED) {
+		i_error("mmap(%s) failed: %m", filename);
+		return NULL;
+	}
+	header = map;
+	if (
+		(memcmp(header, FIRST_SEEN_MAGIC, 4) != 0) ||
+		(get_be32(header + 4) != FIRST_SEEN_VERSION) ||
+		((size_t)sbuf.st_size != HEADER_SIZE + (size_t)get_be32(header + 8) * ENTRY_SIZE)
+	) {
+		i_warning("%s: not a version %d first-seen index", filename, FIRST_SEEN_VERSION);
+		munmap(map, sbuf.st_size);
+		return NULL;
+	}
+
+	index = i_new(struct first_seen_index, 1);
+	index->map = map;
+	index->size = sbuf.st_size;
+	index->count = get_be32(header + 8);
+	index->entries = header + HEADER_SIZE;
+	return index;
+}
+
+void
+first_seen_close(struct first_seen_index **_index)
+{
+	struct first_seen_index *index = *_index;
+
+	if (index == NULL) return;
+	*_index = NULL;
+	munmap(index->map, index->size);
+	i_free(index);
+}
+
+int
+first_seen_lookup(const struct first_seen_index *index, const git_oid *blobid, git_oid *commitid_r, time_t *time_r)
+{
+	const unsigned char *entry;
+	uint32_t lo, hi, mid;
+	int cmp;
+
+	if (index == NULL) return 0;
+	lo = 0;
+	hi = index->count;
+	while (lo < hi) {
+		mid = lo + (hi - lo) / 2;
+		entry = index->entries + (size_t)mid * ENTRY_SIZE;
+		cmp = memcmp(blobid->id, entry, GIT_OID_RAWSZ);
+		if (cmp == 0) {
+			if (commitid_r != NULL) git_oid_fromraw(commitid_r, entry + GIT_OID_RAWSZ);
+			if (time_r != NULL) *time_r = (time_t)get_be64(entry + 2 * GIT_OID_RAWSZ);
+			return 1;
+		}
+		if (cmp < 0) {
+			hi = mid;
+		} else {
+			lo = mid + 1;
+		}
+	}
+	return 0;
+}
@@ -0,0 +1,22 @@
+#ifndef _BANK_PLUGIN_FIRSTSEEN_H_
+#define _BANK_PLUGIN_FIRSTSEEN_H_
+
+#include <time.h>
+#include <git2.h>
+
+/* The first-seen index written by bankrepo.update_first_seen_index():
+   for every version of every transaction in one mailbox directory, the
+   commit where the transaction first appeared and that commit's time.
+   Lets us skip walking the history to find them. */
+struct first_seen_index;
+
+/* Map the index file for dir_path in the repo. Returns NULL if there
+   is none (or it is unusable), in which case lookups find nothing. */
+struct first_seen_index *first_seen_open(git_repository *repo, const char *dir_path);
+void first_seen_close(struct first_seen_index **);
+
+/* Returns 1 and fills in whichever of commitid_r and time_r are not
+   NULL if the blob is in the index, otherwise 0. */
+int first_seen_lookup(const struct first_seen_index *, const git_oid *blobid, git_oid *commitid_r, time_t *time_r);
+
+#endif
@@ -14,6 +14,7 @@
 #include "body.h"
 #include "find.h"
 #include "blob.h"
+#include "firstseen.h"
 
 struct bank_mail {
 	struct index_mail imail;
@@ -96,9 +97,17 @@ get_commit_helper(git_commit *commit, const git_oid *blobid, void *data)
 static int
 get_commit(struct bank_mail *bmail, struct bank_mailbox *mbox)
 {
+	git_oid commitid;
+
 	if (bmail->commit != NULL) {
 		return 0;
 	}
+	if (
+		first_seen_lookup(mbox->first_seen, &(bmail->rec.blobid), &commitid, NULL) &&
+		(git_commit_lookup(&(bmail->commit), mbox->repo, &commitid) == 0)
+	) {
+		return 0;
+	}
 	if (find_versions(mbox->repo, &(bmail->rec.blobid), get_commit_helper, bmail) < 0) {
 		return -1;
 	}
@@ -478,6 +487,9 @@ bank_mail_get_received_date(struct mail *mail, time_t *date_r)
 	struct bank_mailbox *mbox = (struct bank_mailbox *)mail->box;
 
 	if (bmail->commit == NULL) {
+		if (first_seen_lookup(mbox->first_seen, &(bmail->rec.blobid), NULL, date_r)) {
+			return 0;
+		}
 		if (get_commit(bmail, mbox) < 0) {
 			return -1;
 		}
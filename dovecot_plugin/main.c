@@ -19,6 +19,7 @@
 #include "bank.h"
 #include "repo.h"
 #include "mail.h"
+#include "firstseen.h"
 
 struct bank_storage {
 	struct mail_storage storage;
@@ -127,6 +128,7 @@ bank_mailbox_open(struct mailbox *box)
 	i_stream_unref(&input);
 
         if (index_storage_mailbox_open(box, FALSE) < 0) {
+		first_seen_close(&mbox->first_seen);
 		git_repository_free(mbox->repo);
 		mbox->repo = NULL;
 		return -1;
@@ -147,6 +149,7 @@ bank_mailbox_close(struct mailbox *box)
 {
 	struct bank_mailbox *mbox = (struct bank_mailbox *)box;
 
+	first_seen_close(&mbox->first_seen);
 	git_repository_free(mbox->repo);
 	mbox->repo = NULL;
 	index_storage_mailbox_close(box);
@@ -10,6 +10,7 @@
 #include "repo.h"
 #include "bank.h"
 #include "blob.h"
+#include "firstseen.h"
 
 #define SORT_ON_SYNC /* optional feature */
 
@@ -46,6 +47,7 @@ repo_init(struct bank_mailbox *mbox, const char *repo_path, const char *dir_path
 			(error && error->message) ? error->message : "???");
 		return -1;
 	}
+	mbox->first_seen = first_seen_open(mbox->repo, mbox->dirpath);
 
 	return 0;
 }
@@ -95,6 +97,27 @@ bytime(const void *a, const void *b)
 }
 #endif
 
+struct scan_ctx {
+	pool_t pool;
+	HASH_TABLE(git_oid *, struct blob_and_time *) files;
+};
+
+static int
+scan_blob(const char *root, const git_tree_entry *e, void *payload)
+{
+	struct scan_ctx *ctx = (struct scan_ctx *)payload;
+	struct blob_and_time *file_entry;
+
+	/* Subtrees are shards of the sharded layout: walk into them. */
+	if (git_tree_entry_type(e) != GIT_OBJ_BLOB) {
+		return 0;
+	}
+	file_entry = p_new(ctx->pool, struct blob_and_time, 1);
+	file_entry->blobid = *git_tree_entry_id(e);
+	hash_table_insert(ctx->files, &(file_entry->blobid), file_entry);
+	return 0;
+}
+
 static int
 repo_scan(struct bank_mailbox *mbox, git_oid *head_commitid, struct mail_index_transaction *trans, struct mail_index_view *sync_view, uint32_t next_uid)
 {
@@ -105,12 +128,10 @@ repo_scan(struct bank_mailbox *mbox, git_oid *head_commitid, struct mail_index_t
 	json_object *payload;
 	git_tree *tree;
 	git_tree_entry *entry;
-	const git_tree_entry *e;
-	size_t i, nfiles;
+	size_t i;
 	uint32_t uid, seq;
-	pool_t scanpool;
+	struct scan_ctx ctx;
 	struct blob_and_time *file_entry;
-	HASH_TABLE(git_oid *, struct blob_and_time *) files;
 	struct hash_iterate_context *iter;
 	struct bank_mail_index_record index_rec, *brec;
 	unsigned int n_entries;
@@ -145,19 +166,15 @@ repo_scan(struct bank_mailbox *mbox, git_oid *head_commitid, struct mail_index_t
 		return -1;
 	}
 	git_tree_entry_free(entry);
-	nfiles = git_tree_entrycount(tree);
 
-	scanpool = pool_alloconly_create("repo_scan", 4096);
-	hash_table_create(&files, scanpool, 0, blob_hash, blob_cmp);
+	ctx.pool = pool_alloconly_create("repo_scan", 4096);
+	hash_table_create(&ctx.files, ctx.pool, 0, blob_hash, blob_cmp);
 
-	for (i = 0; i < nfiles; i++) {
-		e = git_tree_entry_byindex(tree, i);
-		if (git_tree_entry_type(e) != GIT_OBJ_BLOB) {
-			continue;
-		}
-		file_entry = p_new(scanpool, struct blob_and_time, 1);
-		file_entry->blobid = *git_tree_entry_id(e);
-		hash_table_insert(files, &(file_entry->blobid), file_entry);
+	if (git_tree_walk(tree, GIT_TREEWALK_PRE, scan_blob, &ctx) < 0) {
+		git_tree_free(tree);
+		pool_unref(&ctx.pool);
+		mailbox_set_index_error(&mbox->box);
+		return -1;
 	}
 
 	git_tree_free(tree);
@@ -165,30 +182,35 @@ repo_scan(struct bank_mailbox *mbox, git_oid *head_commitid, struct mail_index_t
 	messages_count = mail_index_view_get_messages_count(sync_view);
         for (mseq = 1; mseq <= messages_count; mseq++) {
 		mail_index_lookup_ext(sync_view, mseq, mbox->bank_ext_id, (const void **)(&brec), NULL);
-		file_entry = hash_table_lookup(files, &(brec->blobid));
+		file_entry = hash_table_lookup(ctx.files, &(brec->blobid));
 		if (file_entry == NULL) {
                 	mail_index_expunge(trans, mseq);
 		} else {
-			hash_table_remove(files, &(brec->blobid));
+			hash_table_remove(ctx.files, &(brec->blobid));
 		}
         }
 
-	n_entries = hash_table_count(files);
+	n_entries = hash_table_count(ctx.files);
 	if (n_entries == 0) {
-		pool_unref(&scanpool);
+		pool_unref(&ctx.pool);
 		return 0;
 	}
 
-	file_entry_list = p_new(scanpool, struct blob_and_time *, n_entries);
+	file_entry_list = p_new(ctx.pool, struct blob_and_time *, n_entries);
 	i = 0;
 
-	iter = hash_table_iterate_init(files);
-	while (hash_table_iterate(iter, files, &blobid, &file_entry)) {
+	iter = hash_table_iterate_init(ctx.files);
+	while (hash_table_iterate(iter, ctx.files, &blobid, &file_entry)) {
 #ifdef SORT_ON_SYNC
 		/* Fetching the transaction time makes sync a little
 		   slower, and all it does is cause the uids to be
-		   assigned more or less in transaction time sequence. */
-		if (git_blob_lookup(&blob, mbox->repo, blobid) == 0) {
+		   assigned more or less in transaction time sequence.
+		   The time it was first seen will do as well, and
+		   is cheaper if it is in the first-seen index. */
+		if (
+			(!first_seen_lookup(mbox->first_seen, blobid, NULL, &(file_entry->timestamp))) &&
+			(git_blob_lookup(&blob, mbox->repo, blobid) == 0)
+		) {
 			payload = parse_blob(blob);
 			if (payload != NULL) {
 				blob_get_date(payload, &(file_entry->timestamp));
@@ -213,7 +235,7 @@ repo_scan(struct bank_mailbox *mbox, git_oid *head_commitid, struct mail_index_t
 		uid++;
 	}
 
-	pool_unref(&scanpool);
+	pool_unref(&ctx.pool);
 	return 0;
 }
 
@@ -264,6 +286,9 @@ repo_sync(struct bank_mailbox *mbox)
 	}
 
 	if (need_scan) {
+		/* The index is replaced, not updated, when there are new commits. */
+		first_seen_close(&mbox->first_seen);
+		mbox->first_seen = first_seen_open(mbox->repo, mbox->dirpath);
 		if (repo_scan(mbox, &head_commitid, trans, sync_view, hdr->next_uid) < 0) {
 			mailbox_set_index_error(&mbox->box);
 		}
@@ -1,7 +1,11 @@
 #!/usr/bin/python
 
+import codecs
 import contextlib
+import email.utils
+import errno
 import fcntl
+import hashlib
 try:
     import http.client
 except ImportError:
@@ -10,37 +14,238 @@ else:
     httplib = http.client
 import json
 import os
+import random
+import re
+import socket
 import subprocess
+import sys
+import threading
+import time
+
+import lib
+
+
+STATE_FILE = "../fetch_state"
+
+# Seconds that a whole fetch run may take, from waiting for the lock
+# through to committing, before giving up.
+RUN_BUDGET = 10 * 60
+
+# Seconds to wait for another run to release the lock. Runs are
+# frequent, so if one is taking a while it is better for the next one
+# to give up and leave it alone than to queue up behind it.
+LOCK_TIMEOUT = 60
+
+# A lock holder running for longer than this is reported as stuck.
+STALE_LOCK_AGE = 2 * RUN_BUDGET
+
+# Socket timeout for each API request, in seconds.
+REQUEST_TIMEOUT = 60
+
+# Responses worth trying again after a while.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Where push() records how far behind origin is, in the project dir,
+# also in the Prometheus textfile format. That is kept apart from
+# METRICS_FILE since pushes happen after the fetch run has ended.
+PUSH_STATUS_FILE = "push_status"
+PUSH_METRICS_FILE = "push.prom"
+
+# Consecutive failed pushes before giving up until the next run,
+# and the initial backoff between them in seconds.
+PUSH_ATTEMPTS = 5
+PUSH_BACKOFF = 2.0
+
+# Seconds a single git push may take before it is killed, so that a
+# hung push doesn't hold push.lock forever.
+PUSH_TIMEOUT = 300
+
+# Push from a thread instead of in the foreground.
+BACKGROUND_PUSH = False
+
+# maintain() packs the repos when they have more loose objects or
+# packs than these. Each run adds a few dozen loose objects.
+MAINTENANCE_LOOSE_OBJECTS = 2000
+MAINTENANCE_PACKS = 20
+
+# Where maintain() records what it last did, in the project dir.
+MAINTENANCE_STATUS_FILE = "maintenance_status"
+
+# Do maintenance from a thread instead of in the foreground.
+BACKGROUND_MAINTENANCE = False
+
+# Where fetcher_main() writes metrics about the run, in the project dir,
+# in the Prometheus textfile format.
+METRICS_FILE = "fetch.prom"
+
+# How the item files in each account (or category, or currency)
+# directory are laid out: 'flat', or 'sharded' into subdirectories named
+# after a hash of the file name, which keeps each git tree small as the
+# history grows. Worked out from the committed files; see set_layout().
+LAYOUTS = ('flat', 'sharded')
+
+_run_deadline = None
+_run_start = None
+_layout = 'flat'
+_item_depth = None
 
 
 @contextlib.contextmanager
-def fetcher_main(project_dir):
+def fetcher_main(project_dir, write_metrics=False, item_depth=None):
     """cd to <project_dir>/work, grab an exclusive lock
 
     <project_dir> should contain:
     - A subdirectory called 'work', which is a checked-out git repo
-      which we will use as a workspace to prepare a commit, and then
-      push that commit.
+      which we will use as a workspace to prepare a commit. Use push()
+      after leaving the context to push that commit.
     - A plain file 'lock', which we will create, to make sure there
-      is only one of us in there.
+      is only one of us in there. The holder writes its PID and start
+      time into it. If the lock can't be had within LOCK_TIMEOUT,
+      give up and say who has it.
+    - A plain file 'fetch_state', which we will create, to remember
+      things from one run to the next.
+
+    Yields the fetcher state (a dict) which is saved again if the
+    body completes without raising.
+
+    With write_metrics (for fetch runs, not other users of the lock),
+    the run's metrics are written to METRICS_FILE at the end, including
+    whether it succeeded, even if the lock could not be had.
+
+    item_depth (for fetch runs) is how many path components the item
+    files have in the flat layout, e.g. 2 for <account>/<item>. The
+    layout is then worked out from what is committed at HEAD.
     """
-    os.chdir(os.path.join(os.path.expanduser(project_dir), "work"))
+    start_run()
+    project_dir = os.path.expanduser(project_dir)
+    os.chdir(os.path.join(project_dir, "work"))
     lock = os.open("../lock", os.O_CREAT|os.O_RDWR, 0o666)
-    fcntl.lockf(lock, fcntl.LOCK_EX)
+    success = False
     try:
-        yield None
+        _acquire_lock(lock, min(LOCK_TIMEOUT, time_left()))
+        state = load_state()
+        if item_depth is not None:
+            global _layout, _item_depth
+            _item_depth = item_depth
+            # The state only says which layout to start an empty repo in.
+            _layout = _head_items()[1] or state.get('layout', 'flat')
+        yield state
+        save_state(state)
+        success = True
     finally:
         os.close(lock)
+        if write_metrics:
+            metrics.set('bank_fetch_success', int(success))
+            _write_metrics(project_dir)
+
 
+def _acquire_lock(lock, timeout):
+    give_up = time.time() + timeout
+    while True:
+        try:
+            fcntl.lockf(lock, fcntl.LOCK_EX|fcntl.LOCK_NB, 0, 0, os.SEEK_SET)
+            break
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+        if time.time() >= give_up:
+            raise RuntimeError(_lock_holder(lock))
+        time.sleep(1)
+    os.ftruncate(lock, 0)
+    os.lseek(lock, 0, os.SEEK_SET)
+    os.write(lock, ('%d %d\n' % (os.getpid(), time.time())).encode())
+
+
+def _lock_holder(lock):
+    """Describe who is holding the lock, for the error message."""
+    os.lseek(lock, 0, os.SEEK_SET)
+    try:
+        pid, started = os.read(lock, 100).decode().split()
+        pid, started = int(pid), int(started)
+    except ValueError:
+        return 'Lock is held by an unknown process'
+    age = time.time() - started
+    msg = 'Lock is held by pid %d, running for %d seconds' % (pid, age)
+    if age > STALE_LOCK_AGE:
+        msg += '; it seems to be stuck'
+    return msg
 
-def fetch(importer):
+
+def start_run(budget=RUN_BUDGET):
+    global _run_deadline, _run_start
+    _run_start = time.time()
+    _run_deadline = _run_start + budget
+    metrics.clear()
+
+
+def time_left():
+    """Seconds remaining in this run's budget, or None if unlimited."""
+    if _run_deadline is None:
+        return None
+    return _run_deadline - time.time()
+
+
+def check_deadline():
+    left = time_left()
+    if left is not None and left <= 0:
+        raise RuntimeError('Run deadline exceeded')
+    return left
+
+
+def request_timeout():
+    """Socket timeout for the next request, within the run's deadline."""
+    left = check_deadline()
+    if left is None:
+        return REQUEST_TIMEOUT
+    return min(REQUEST_TIMEOUT, left)
+
+
+def load_state(filename=STATE_FILE):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return {}
+
+
+def save_state(state, filename=STATE_FILE):
+    with lib.atomic_write(filename) as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def full_resync_due(state, interval):
+    """Whether it has been more than <interval> since the last full resync.
+
+    Incremental fetchers should do a full resync every now and then
+    in case something changed behind their watermark.
+    """
+    last = state.get('last_full_resync')
+    return last is None or time.time() - last > interval.total_seconds()
+
+
+def full_resync_done(state):
+    state['last_full_resync'] = time.time()
+
+
+def fetch(importer, audit=None):
     """Prepare the workspace, import, then maybe commit the result.
 
     - Prepare (clean) the workspace
     - Use a bank-specific import function to download transactions
     - If anything was changed in the workspace, commit it.
+
+    Incremental importers only write what changed since the last
+    commit, so the workspace has to match that commit exactly.
+
+    If given, audit(changes, prev_commit_time) checks the changes about
+    to be committed (see staged_changes()) and returns lists of
+    violations and of warnings. They are recorded as trailers in the
+    commit message and violations are also printed, so that they are
+    noticed right away rather than at the next full audit.
     """
-    subprocess.check_call(('git', 'clean', '-f', '-d', '-q'))
+    _reset_workspace()
 
     importer()
 
@@ -48,26 +253,625 @@ def fetch(importer):
     stdout, stderr = p.communicate()
     if p.returncode != 0:
         raise RuntimeError('git status --porcelain failed')
+    files = [(line[:1], line[3:].decode('utf-8')) for line in stdout.splitlines()]
+    changes = [status for status, path in files]
+    metrics.set('bank_fetch_items_new', changes.count(b'A'))
+    metrics.set('bank_fetch_items_changed', changes.count(b'M'))
     if not stdout:
         return  # nothing to import
 
+    message = 'Fetched transactions'
+    if audit is not None:
+        with metrics.timer('bank_fetch_audit_seconds'):
+            violations, warnings = audit(staged_changes(files), _head_time())
+        metrics.set('bank_fetch_audit_violations', len(violations))
+        metrics.set('bank_fetch_audit_warnings', len(warnings))
+        for v in violations:
+            sys.stderr.write('Audit violation: %s\n' % (v,))
+        trailers = ['Audit-Violation: ' + v for v in violations]
+        trailers.extend('Audit-Warning: ' + w for w in warnings)
+        if trailers:
+            message += '\n\n' + '\n'.join(trailers)
+
+    with metrics.timer('bank_fetch_commit_seconds'):
+        _commit(message)
+
+
+def staged_changes(files):
+    """The added and modified items about to be committed.
+
+    files is a list of (status, path) from git status. Returns a list
+    of (path, payload at HEAD or None if new, staged payload).
+    """
+    result = []
+    for status, path in files:
+        if status not in (b'A', b'M'):
+            continue
+        with codecs.open(path, 'r', 'utf-8') as f:
+            payload = json.load(f)
+        prev_payload = None
+        if status == b'M':
+            prev_payload = json.loads(subprocess.check_output(
+                ('git', 'show', 'HEAD:' + path)).decode('utf-8'))
+        result.append((path, prev_payload, payload))
+    return result
+
+
+def _head_time():
+    """Commit time of HEAD, or None if there are no commits yet."""
+    p = subprocess.Popen(('git', 'log', '-1', '--format=%ct'),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0 or not stdout.strip():
+        return None
+    return int(stdout)
+
+
+def _has_head():
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(
+            ('git', 'rev-parse', '-q', '--verify', 'HEAD'), stdout=devnull) == 0
+
+
+def _reset_workspace():
+    subprocess.check_call(('git', 'clean', '-f', '-d', '-q'))
+    if _has_head():
+        subprocess.check_call(('git', 'reset', '-q', '--hard'))
+
+
+def _commit(message):
     env = os.environ.copy()
     env['TZ'] = 'Europe/London'
     author = 'Transaction Fetcher <vandry@TZoNE.ORG>'
+    # No automatic gc while holding the fetch lock; see maintain().
     p = subprocess.Popen(
-        ('git', 'commit', '-m', 'Fetched transactions', '--author', author, '-q'),
+        ('git', '-c', 'gc.auto=0', 'commit', '-m', message, '--author', author, '-q'),
         env=env
     )
     status = p.wait()
     if status != 0:
         raise RuntimeError('No commit')
 
-    subprocess.check_call(('git', 'push', '-q', 'origin', 'master'))
+
+def _shard(name):
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()[:2]
+
+
+def item_path(directory, name):
+    """Where the file for item <name> in <directory> goes."""
+    if _layout == 'sharded':
+        return os.path.join(directory, _shard(name), name)
+    return os.path.join(directory, name)
+
+
+def item_files(directory):
+    """All the item files in <directory>, whatever the layout."""
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for fn in filenames:
+            yield os.path.join(dirpath, fn)
+
+
+def _item_directory(path):
+    directory, name = os.path.split(path)
+    if os.path.basename(directory) == _shard(name):
+        return os.path.dirname(directory)
+    return directory
+
+
+def _head_items():
+    """(paths, layout) of the item files committed at HEAD.
+
+    Item files are _item_depth path components deep in the flat layout,
+    or one more with a shard directory in the sharded layout. Anything
+    else (e.g. a README at the root) is not an item. layout is None if
+    there are no items, and it is an error to find both layouts.
+    """
+    if not _has_head():
+        return [], None
+    p = subprocess.Popen(('git', 'ls-tree', '-r', '--name-only', '-z', 'HEAD'),
+                         stdout=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError('git ls-tree failed')
+    paths = []
+    layouts = set()
+    for path in stdout.decode('utf-8').split('\0'):
+        parts = path.split('/')
+        if len(parts) == _item_depth:
+            layouts.add('flat')
+        elif len(parts) == _item_depth + 1 and parts[-2] == _shard(parts[-1]):
+            layouts.add('sharded')
+        else:
+            continue
+        paths.append(path)
+    if len(layouts) > 1:
+        raise RuntimeError('Items are committed in both the flat and the sharded layout')
+    return paths, layouts.pop() if layouts else None
+
+
+def set_layout(state, layout):
+    """Use <layout> from now on.
+
+    If the committed items are in a different layout, move every item
+    file and commit that on its own, before any fetching.
+    """
+    global _layout
+    if layout not in LAYOUTS:
+        raise RuntimeError('Unknown layout ' + layout)
+    if _item_depth is None:
+        raise RuntimeError('set_layout() needs fetcher_main() with item_depth')
+    _layout = layout
+    state['layout'] = layout
+    _reset_workspace()
+    paths, current = _head_items()
+    if current in (None, layout):
+        return
+    for path in paths:
+        os.renames(path, item_path(_item_directory(path), os.path.basename(path)))
+    subprocess.check_call(('git', 'add', '-A'))
+    _commit('Changed to %s layout' % (layout,))
+
+
+def layout_arg():
+    """The layout asked for with --layout=, if any."""
+    for arg in sys.argv[1:]:
+        if arg.startswith('--layout='):
+            return arg.split('=', 1)[1]
+    return None
+
+
+def stage(fn, item):
+    """Write a downloaded item to file fn and add it to the index."""
+    with metrics.timer('bank_fetch_stage_seconds'):
+        directory = os.path.dirname(fn)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(fn, "w") as f:
+            json.dump(item, f, indent=2, sort_keys=True)
+        subprocess.check_call(('git', 'add', fn))
+
+
+def unpushed_commit_times(work_dir):
+    """Commit times of the commits on master that origin does not have."""
+    p = subprocess.Popen(
+        ('git', '-C', work_dir, 'rev-list', '--timestamp', 'master', '--not', '--remotes=origin'),
+        stdout=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError('git rev-list failed')
+    return [int(line.split()[0]) for line in stdout.splitlines()]
+
+
+def _push_pending(project_dir):
+    """Push until origin has caught up with master, or give up."""
+    work_dir = os.path.join(project_dir, "work")
+    status = load_state(os.path.join(project_dir, PUSH_STATUS_FILE))
+    attempt = 0
+    while True:
+        times = unpushed_commit_times(work_dir)
+        status['unpushed_commits'] = len(times)
+        status['oldest_unpushed_commit_time'] = min(times) if times else None
+        _save_push_status(project_dir, status)
+        if not times:
+            return
+        if attempt > 0:
+            time.sleep(random.uniform(0, PUSH_BACKOFF * 2 ** (attempt - 1)))
+        attempt += 1
+        start = time.time()
+        if _call(('git', '-C', work_dir, 'push', '-q', 'origin', 'master'), PUSH_TIMEOUT) == 0:
+            status['last_push_time'] = time.time()
+            status['last_push_seconds'] = status['last_push_time'] - start
+            attempt = 0
+        else:
+            status['last_push_failure_time'] = time.time()
+            if attempt >= PUSH_ATTEMPTS:
+                _save_push_status(project_dir, status)
+                raise RuntimeError('git push failed')
+
+
+def _save_push_status(project_dir, status):
+    save_state(status, os.path.join(project_dir, PUSH_STATUS_FILE))
+    push_metrics = Metrics()
+    if 'last_push_seconds' in status:
+        push_metrics.set('bank_push_seconds', status['last_push_seconds'])
+    push_metrics.set('bank_push_unpushed_commits', status['unpushed_commits'])
+    if status.get('oldest_unpushed_commit_time') is not None:
+        push_metrics.set('bank_push_oldest_unpushed_commit_timestamp_seconds',
+                         status['oldest_unpushed_commit_time'])
+    _write_prom(push_metrics, project_dir, PUSH_METRICS_FILE)
+
+
+def _call(args, timeout):
+    """Like subprocess.call, but kill the command after timeout seconds."""
+    p = subprocess.Popen(args)
+    give_up = time.time() + timeout
+    while p.poll() is None:
+        if time.time() >= give_up:
+            p.kill()
+            sys.stderr.write('%s timed out\n' % (' '.join(args),))
+            break
+        time.sleep(0.1)
+    return p.wait()
+
+
+def push(project_dir):
+    """Push new commits from <project_dir>/work to origin.
+
+    This is done outside of the fetch lock, so that a slow remote never
+    holds up fetching. Pushes are serialized by their own lock; whoever
+    holds it keeps pushing until origin has every commit, including ones
+    made by other runs while it was busy, which then don't need to push
+    themselves.
+
+    <project_dir>/push_status records how far behind origin is, for
+    alerting on push lag.
+
+    With BACKGROUND_PUSH, return immediately and push from a thread.
+    """
+    project_dir = os.path.expanduser(project_dir)
+    if BACKGROUND_PUSH:
+        t = threading.Thread(target=_push, args=(project_dir,))
+        t.daemon = True
+        t.start()
+    else:
+        _push(project_dir)
+
+
+def _push(project_dir):
+    lock = os.open(os.path.join(project_dir, "push.lock"), os.O_CREAT|os.O_RDWR, 0o666)
+    try:
+        while True:
+            try:
+                fcntl.lockf(lock, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+                return  # the holder will push our commits too
+            try:
+                _push_pending(project_dir)
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+            # Someone may have committed, and failed to get the lock,
+            # just before we released it.
+            if not unpushed_commit_times(os.path.join(project_dir, "work")):
+                return
+    finally:
+        os.close(lock)
+
+
+def object_counts(repo_path):
+    """(loose objects, packs) in the repo at repo_path."""
+    p = subprocess.Popen(('git', '-C', repo_path, 'count-objects', '-v'), stdout=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError('git count-objects failed')
+    counts = dict(line.decode('utf-8').split(': ', 1) for line in stdout.splitlines())
+    return int(counts['count']), int(counts['packs'])
+
+
+def maintain_repo(repo_path, full=False):
+    """Pack the repo's loose objects and write a commit-graph.
+
+    The new pack is rolled up with any smaller ones so that the pack
+    sizes stay a geometric progression, and a multi-pack-index with a
+    reachability bitmap is written over them all (which needs git 2.32
+    or later), so every maintenance leaves a bitmap. With full (or when
+    there are too many packs), repack everything into a single pack
+    instead. The commit-graph is written as a chain of split files, so
+    each time only the new commits go into a new file.
+    """
+    loose, packs = object_counts(repo_path)
+    if full or packs >= MAINTENANCE_PACKS:
+        repack = ('repack', '-a', '-d', '-q', '--write-midx', '--write-bitmap-index')
+    else:
+        repack = ('repack', '--geometric=2', '-d', '-q', '--write-midx', '--write-bitmap-index')
+    for args in (repack, ('commit-graph', 'write', '--reachable', '--split')):
+        if subprocess.call(('git', '-C', repo_path) + args) != 0:
+            raise RuntimeError('git %s failed' % (args[0],))
+
+
+def _maintained_repos(project_dir):
+    """The work repo, and origin if it is a local repo."""
+    work_dir = os.path.join(project_dir, "work")
+    repos = [work_dir]
+    p = subprocess.Popen(('git', '-C', work_dir, 'remote', 'get-url', 'origin'),
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    url = stdout.decode('utf-8').strip()
+    if p.returncode == 0 and url and os.path.isdir(os.path.join(work_dir, url)):
+        repos.append(os.path.join(work_dir, url))
+    return repos
+
+
+def maintain(project_dir):
+    """Pack the work repo and origin if they need it.
+
+    Every fetch leaves loose objects behind, which make walking the
+    history (bankrepo, the Dovecot plugin) slower and slower. Commits
+    don't trigger git's own automatic gc, which would happen while the
+    fetch lock is held; instead this runs after the fetch, under its own
+    lock, and only does anything when MAINTENANCE_LOOSE_OBJECTS or
+    MAINTENANCE_PACKS is reached. If another run is already doing
+    maintenance, it is left to it.
+
+    <project_dir>/maintenance_status records the object counts and the
+    last maintenance, for the metrics.
+
+    With BACKGROUND_MAINTENANCE, return immediately and do it from a thread.
+    """
+    project_dir = os.path.expanduser(project_dir)
+    if BACKGROUND_MAINTENANCE:
+        t = threading.Thread(target=_maintain, args=(project_dir,))
+        t.daemon = True
+        t.start()
+    else:
+        _maintain(project_dir)
+
+
+def _maintain(project_dir):
+    lock = os.open(os.path.join(project_dir, "maintenance.lock"), os.O_CREAT|os.O_RDWR, 0o666)
+    try:
+        try:
+            fcntl.lockf(lock, fcntl.LOCK_EX|fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            return
+        status_file = os.path.join(project_dir, MAINTENANCE_STATUS_FILE)
+        status = load_state(status_file)
+        for repo_path in _maintained_repos(project_dir):
+            loose, packs = object_counts(repo_path)
+            if loose < MAINTENANCE_LOOSE_OBJECTS and packs < MAINTENANCE_PACKS:
+                continue
+            start = time.time()
+            maintain_repo(repo_path)
+            status['last_maintenance_time'] = time.time()
+            status['last_maintenance_seconds'] = status['last_maintenance_time'] - start
+        status['loose_objects'], status['packs'] = object_counts(os.path.join(project_dir, "work"))
+        save_state(status, status_file)
+    finally:
+        os.close(lock)
+
+
+METRICS_HELP = {
+    'bank_fetch_success': 'Whether the last fetch run succeeded.',
+    'bank_fetch_run_seconds': 'Duration of the last fetch run.',
+    'bank_fetch_last_run_timestamp_seconds': 'When the last fetch run ended.',
+    'bank_fetch_requests': 'API request attempts made, by endpoint and status (or error).',
+    'bank_fetch_retries': 'API requests retried, by endpoint and cause (status or error).',
+    'bank_fetch_request_seconds': 'Time until the response headers arrived, summed over attempts, by endpoint.',
+    'bank_fetch_request_total_seconds': 'Time spent on requests including pacing and retries, by endpoint.',
+    'bank_fetch_response_bytes': 'Response body bytes received, by endpoint.',
+    'bank_fetch_items_received': 'Items received, by endpoint.',
+    'bank_fetch_items_new': 'Items added by the last fetch run.',
+    'bank_fetch_items_changed': 'Items changed by the last fetch run.',
+    'bank_fetch_stage_seconds': 'Time spent writing items and adding them to the index.',
+    'bank_fetch_commit_seconds': 'Time spent committing.',
+    'bank_fetch_audit_seconds': 'Time spent auditing the changes before committing.',
+    'bank_fetch_audit_violations': 'Audit violations in the last commit.',
+    'bank_fetch_audit_warnings': 'Audit warnings in the last commit.',
+    'bank_push_seconds': 'Duration of the last successful push.',
+    'bank_push_unpushed_commits': 'Commits not yet pushed to origin.',
+    'bank_push_oldest_unpushed_commit_timestamp_seconds': 'Commit time of the oldest unpushed commit.',
+    'bank_repo_loose_objects': 'Loose objects in the work repo after the last maintenance check.',
+    'bank_repo_packs': 'Packs in the work repo after the last maintenance check.',
+    'bank_maintenance_seconds': 'Duration of the last repo maintenance.',
+}
+
+_ID_SEGMENT_RE = re.compile(r'/(?:[0-9]+|[0-9a-f]{8}-[0-9a-f-]+)(?=/|$)')
+
+
+def endpoint(url):
+    """URL path with the query and any ids removed, to label metrics."""
+    return _ID_SEGMENT_RE.sub('/:id', url.split('?', 1)[0])
+
+
+class Metrics(object):
+    """Values for one run, keyed by metric name and labels."""
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def add(self, name, value, **labels):
+        key = _metric_key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[_metric_key(name, labels)] = value
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start, **labels)
+
+    def format(self, **common_labels):
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = []
+        prev_name = None
+        for (name, labels), value in values:
+            if name != prev_name:
+                lines.append('# HELP %s %s\n' % (name, METRICS_HELP.get(name, name)))
+                lines.append('# TYPE %s gauge\n' % (name,))
+                prev_name = name
+            labels = _metric_key(name, common_labels)[1] + labels
+            lines.append('%s{%s} %r\n' % (name, ','.join(
+                '%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in labels), float(value)))
+        return ''.join(lines)
+
+
+def _metric_key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+metrics = Metrics()
+
+
+def _write_metrics(project_dir):
+    metrics.set('bank_fetch_run_seconds', time.time() - _run_start)
+    metrics.set('bank_fetch_last_run_timestamp_seconds', time.time())
+    maintenance_status = load_state(os.path.join(project_dir, MAINTENANCE_STATUS_FILE))
+    if 'loose_objects' in maintenance_status:
+        metrics.set('bank_repo_loose_objects', maintenance_status['loose_objects'])
+        metrics.set('bank_repo_packs', maintenance_status['packs'])
+    if 'last_maintenance_seconds' in maintenance_status:
+        metrics.set('bank_maintenance_seconds', maintenance_status['last_maintenance_seconds'])
+    _write_prom(metrics, project_dir, METRICS_FILE)
+
+
+def _write_prom(m, project_dir, name):
+    with lib.atomic_write(os.path.join(project_dir, name)) as f:
+        f.write(m.format(bank=os.path.basename(project_dir.rstrip('/'))))
+
+
+class _CountingReader(object):
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, *args):
+        data = self.f.read(*args)
+        self.count += len(data)
+        return data
+
+
+class TokenBucket(object):
+    """Allow <rate> requests per second on average, in bursts of <burst>."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token, first waiting for one to be available."""
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Go into debt so that concurrent callers queue up behind us.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def host_bucket(host, rate, burst):
+    """The TokenBucket shared by everything talking to <host>."""
+    with _buckets_lock:
+        try:
+            return _buckets[host]
+        except KeyError:
+            bucket = _buckets[host] = TokenBucket(rate, burst)
+            return bucket
+
+
+def retry_after(r):
+    """Seconds to wait according to a Retry-After header, or None."""
+    value = r.getheader('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    t = email.utils.parsedate_tz(value)
+    if t is None:
+        return None
+    return max(0, email.utils.mktime_tz(t) - time.time())
+
+
+class RequestScheduler(object):
+    """Send requests to one host, pacing and retrying them.
+
+    Requests are paced by the host's TokenBucket. Transient failures
+    (connection errors and RETRY_STATUSES) are retried up to
+    <max_attempts> times, waiting as asked by Retry-After or else with
+    jittered exponential backoff, but never beyond the run's budget.
+    """
+
+    def __init__(self, host, rate, burst, max_attempts=6, base_delay=1.0, max_delay=60.0):
+        self.bucket = host_bucket(host, rate, burst)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def send(self, attempt, **labels):
+        """Call attempt() until it returns a non-retryable response.
+
+        Each attempt is timed and counted, by status, in the
+        bank_fetch_request_seconds and bank_fetch_requests metrics, and
+        retries in bank_fetch_retries, all with <labels>.
+        """
+        n = 0
+        while True:
+            self.bucket.take()
+            n += 1
+            start = time.time()
+            try:
+                r = attempt()
+            except (socket.error, httplib.HTTPException) as e:
+                metrics.add('bank_fetch_request_seconds', time.time() - start, **labels)
+                metrics.add('bank_fetch_requests', 1, status='error', **labels)
+                delay = None
+                error = str(e)
+                cause = 'error'
+            else:
+                metrics.add('bank_fetch_request_seconds', time.time() - start, **labels)
+                metrics.add('bank_fetch_requests', 1, status=r.status, **labels)
+                if r.status not in RETRY_STATUSES:
+                    return r
+                delay = retry_after(r)
+                error = '%d %s: %s' % (r.status, r.reason, r.read())
+                cause = r.status
+            if delay is None:
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (n - 1)))
+            if n >= self.max_attempts:
+                raise RuntimeError('Giving up after %d attempts: %s' % (n, error))
+            left = time_left()
+            if left is not None and delay > left:
+                raise RuntimeError('Out of time to retry: %s' % (error,))
+            metrics.add('bank_fetch_retries', 1, cause=cause, **labels)
+            time.sleep(delay)
 
 
 class BankAPI(object):
-    def __call__(self, url):
-        conn = httplib.HTTPSConnection(self.HOSTNAME, 443)
+    PORT = 443
+    HTTPS = True
+
+    # Our own limit on how hard we hit the bank.
+    RATE = 5.0
+    BURST = 10
+
+    _scheduler = None
+    _conn = None
+
+    def _connect(self):
+        if self.HTTPS:
+            return httplib.HTTPSConnection(self.HOSTNAME, self.PORT)
+        return httplib.HTTPConnection(self.HOSTNAME, self.PORT)
+
+    def _request(self, conn, url):
+        conn.timeout = request_timeout()
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
         headers = {
             "Authorization": "Bearer " + self.token,
             "User-Agent": "https://github.com/vandry/banks",
@@ -81,6 +885,162 @@ class BankAPI(object):
             headers['X-Signature'] = self.sign_2fa(twotoken)
             conn.request("GET", url, headers=headers)
             r = conn.getresponse()
+        return r
+
+    def _attempt(self, url):
+        """Make a request, reusing the connection from last time if possible.
+
+        Each response must be read to the end before the next request.
+        """
+        if self._conn is not None:
+            try:
+                return self._request(self._conn, url)
+            except (socket.error, httplib.HTTPException):
+                # Most likely the server closed the idle connection.
+                self._conn.close()
+        self._conn = self._connect()
+        try:
+            return self._request(self._conn, url)
+        except (socket.error, httplib.HTTPException):
+            self._conn.close()
+            self._conn = None
+            raise
+
+    def _get(self, url):
+        if self._scheduler is None:
+            self._scheduler = RequestScheduler(self.HOSTNAME, self.RATE, self.BURST)
+        with metrics.timer('bank_fetch_request_total_seconds', endpoint=endpoint(url)):
+            r = self._scheduler.send(lambda: self._attempt(url), endpoint=endpoint(url))
         if r.status != 200:
             raise RuntimeError('%d %s: %s' % (r.status, r.reason, r.read()))
-        return json.loads(r.read().decode('utf-8'))
+        return r
+
+    def __call__(self, url):
+        data = self._get(url).read()
+        metrics.add('bank_fetch_response_bytes', len(data), endpoint=endpoint(url))
+        return json.loads(data.decode('utf-8'))
+
+    def stream(self, url, key):
+        """Yield the items of the array <key> in the response one by one.
+
+        The response must be a JSON object. The array is parsed from
+        the socket as it arrives, so only one item at a time needs to
+        be held in memory. The other members of the object are skipped.
+        """
+        r = _CountingReader(self._get(url))
+        try:
+            for item in iter_json_array(r, key):
+                check_deadline()
+                metrics.add('bank_fetch_items_received', 1, endpoint=endpoint(url))
+                yield item
+            r.read()
+        finally:
+            metrics.add('bank_fetch_response_bytes', r.count, endpoint=endpoint(url))
+
+
+_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+# What a chunk boundary can leave of a token cut in two: part of a
+# number, or of true, false or null.
+_PARTIAL_TOKEN_RE = re.compile(r'(?:[-+.eE0-9]*|t(?:r(?:ue?)?)?|f(?:a(?:l(?:se?)?)?)?|n(?:u(?:ll?)?)?)$')
+# What may follow a complete value.
+_DELIMITERS = ' \t\n\r,:]}'
+
+
+class _JSONStream(object):
+    """Tokenizer over a file-like object holding a JSON document."""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        if self.eof:
+            raise ValueError('Truncated JSON document')
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + self.utf8.decode(data, final=self.eof)
+        self.pos = 0
+
+    def peek(self):
+        """Skip whitespace and return the next character."""
+        while True:
+            self.pos = _WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            self._more()
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError('Expected %r in JSON document' % (c,))
+        self.pos += 1
+
+    def _cut_off(self, pos):
+        """Whether the buffer from pos could be the start of a token that
+        continues in the next chunk."""
+        pos = _WHITESPACE_RE.match(self.buf, pos).end()
+        return not self.eof and _PARTIAL_TOKEN_RE.match(self.buf, pos) is not None
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                v, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError as e:
+                # Only more of the document can help if decoding failed
+                # at the end of the buffer.
+                pos = getattr(e, 'pos', None)
+                if (pos is None or 'Unterminated string' in str(e) or self._cut_off(pos) or
+                        # Part of a \uXXXX escape (or a surrogate pair of them).
+                        ('escape' in str(e) and len(self.buf) - pos < 12 and not self.eof)):
+                    self._more()
+                    continue
+                raise
+            if end == len(self.buf) or self.buf[end] not in _DELIMITERS:
+                # A number (e.g. "1." of "1.5") might continue in the
+                # next chunk.
+                if self._cut_off(end):
+                    self._more()
+                    continue
+                if end < len(self.buf):
+                    raise ValueError('Expected a delimiter after JSON value')
+            self.pos = end
+            return v
+
+
+def iter_json_array(f, key, chunk_size=65536):
+    """Yield the items of array <key> in the JSON object read from f."""
+    s = _JSONStream(f, chunk_size)
+    s.expect('{')
+    if s.peek() == '}':
+        return
+    while True:
+        k = s.value()
+        s.expect(':')
+        if k == key:
+            s.expect('[')
+            if s.peek() == ']':
+                s.pos += 1
+            else:
+                while True:
+                    yield s.value()
+                    c = s.peek()
+                    s.pos += 1
+                    if c == ']':
+                        break
+                    if c != ',':
+                        raise ValueError('Expected , or ] in JSON array')
+        else:
+            s.value()
+        c = s.peek()
+        s.pos += 1
+        if c == '}':
+            return
+        if c != ',':
+            raise ValueError('Expected , or } in JSON object')
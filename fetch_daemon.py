@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+#
+# Usage:
+#
+#  import sys
+#  sys.path.insert(0, "/wherever/this/is")
+#  import fetch_daemon
+#  fetch_daemon.main()
+#
+# with the banks to fetch from as arguments, e.g. "starling monzo wise",
+# and optionally --audit to audit Starling changes before committing them.
+# A bank can be given as bank=seconds, e.g. "wise=3600", to fetch from it
+# at a different interval than the one in INTERVALS.
+# Runs forever, as an alternative to running each fetcher from cron.
+
+import heapq
+import random
+import sys
+import time
+import traceback
+
+import fetch_base
+
+
+# How often to fetch from each bank by default, and how much to randomly
+# vary that by (as a fraction) so that the banks don't all get fetched in
+# lockstep. Wise statements only have completed transactions, so there is
+# less to gain from asking often.
+INTERVAL = 15 * 60
+INTERVALS = {
+    'starling': INTERVAL,
+    'monzo': INTERVAL,
+    'wise': 60 * 60,
+}
+JITTER = 0.1
+
+# How soon to try again after the Monzo token could not be refreshed.
+REFRESH_RETRY = 5 * 60
+
+
+def jittered(interval):
+    return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+
+def fetch_job(run, api, interval):
+    """A job running one bank's fetcher every interval seconds, keeping
+    its API client warm."""
+    def job():
+        run(api)
+        return jittered(interval)
+    job.interval = interval
+    return job
+
+
+def monzo_refresh_job():
+    import monzo.oauth
+
+    def job():
+        due = monzo.oauth.refresh_due()
+        if due <= 0:
+            try:
+                monzo.oauth.refresh()
+            except Exception:
+                traceback.print_exc()
+                return REFRESH_RETRY
+            due = monzo.oauth.refresh_due()
+        return max(due, 0)
+    job.interval = REFRESH_RETRY
+    return job
+
+
+def make_jobs(bank, audit=False, interval=None):
+    if interval is None:
+        interval = INTERVALS.get(bank, INTERVAL)
+    if bank == 'starling':
+        import starling.fetch
+        return [fetch_job(
+            lambda api: starling.fetch.run(api, audit=audit), starling.fetch.StarlingAPI(),
+            interval)]
+    if bank == 'monzo':
+        import monzo.fetch
+        # Refresh first so that the fetcher starts with a valid token.
+        return [
+            monzo_refresh_job(),
+            fetch_job(monzo.fetch.run, monzo.fetch.MonzoAPI(), interval),
+        ]
+    if bank == 'wise':
+        import wise.fetch
+        return [fetch_job(wise.fetch.run, wise.fetch.WiseAPI(), interval)]
+    raise RuntimeError('Unknown bank ' + bank)
+
+
+def main():
+    banks = []
+    audit = False
+    for arg in sys.argv[1:]:
+        if arg == '--audit':
+            audit = True
+        elif '=' in arg:
+            bank, interval = arg.split('=', 1)
+            banks.append((bank, float(interval)))
+        else:
+            banks.append((arg, None))
+    if not banks:
+        raise RuntimeError('Usage: [--audit] bank[=seconds]...')
+    fetch_base.BACKGROUND_PUSH = True
+    fetch_base.BACKGROUND_MAINTENANCE = True
+    queue = []
+    for bank, interval in banks:
+        for job in make_jobs(bank, audit, interval):
+            heapq.heappush(queue, (time.time(), len(queue), job))
+    # Jobs run one at a time since the fetchers chdir into their workspace.
+    while True:
+        when, seq, job = heapq.heappop(queue)
+        delay = when - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            next_delay = job()
+        except Exception:
+            traceback.print_exc()
+            next_delay = jittered(job.interval)
+        heapq.heappush(queue, (time.time() + next_delay, seq, job))
@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""One view of the transactions from every bank.
+
+Reads each bank's repo (in parallel, one process per repo) and turns
+the latest version of every transaction into a Record of the same shape
+whatever the bank, merged into a single list in time order.
+
+Usage: ledger.py [--daily] [BANK=REPO...]
+
+prints the money in and out per month (or day) and currency across all
+the banks. Without arguments, reads the repos in REPOS.
+"""
+
+import calendar
+import collections
+import concurrent.futures
+import datetime
+import decimal
+import os
+import sys
+
+import bankrepo
+import lib
+
+
+# Where each bank's repo is, and whether it has categories within accounts.
+REPOS = {
+    'starling': ('~/starling/.git', True),
+    'monzo': ('~/monzo/.git', False),
+    'wise': ('~/wise/.git', True),
+}
+
+# Digits after the decimal point in each currency's minor unit, where
+# that is not 2 (ISO 4217). Wise gives amounts in major units.
+MINOR_UNIT_DIGITS = {
+    'BIF': 0, 'CLP': 0, 'DJF': 0, 'GNF': 0, 'ISK': 0, 'JPY': 0, 'KMF': 0,
+    'KRW': 0, 'PYG': 0, 'RWF': 0, 'UGX': 0, 'UYI': 0, 'VND': 0, 'VUV': 0,
+    'XAF': 0, 'XOF': 0, 'XPF': 0,
+    'BHD': 3, 'IQD': 3, 'JOD': 3, 'KWD': 3, 'LYD': 3, 'OMR': 3, 'TND': 3,
+    'CLF': 4, 'UYW': 4,
+}
+
+Record = collections.namedtuple('Record', (
+    'bank',
+    'id',
+    'account',       # account id, or account/category
+    'minor_units',   # signed: negative is money out
+    'currency',
+    'status',        # PENDING, SETTLED, DECLINED, ...
+    'event_time',    # when the transaction happened, seconds since the epoch
+    'update_time',   # when the bank last changed it
+    'counterparty',
+))
+
+
+def _epoch(t):
+    parsed = lib.parse_iso8601(t)
+    return calendar.timegm(parsed.timetuple()) + parsed.microsecond / 1e6
+
+
+def minor_units(value, currency):
+    """A major-unit amount (a JSON number) in the currency's minor units."""
+    digits = MINOR_UNIT_DIGITS.get(currency, 2)
+    # Through the shortest decimal form, so that e.g. 0.29 is not 28.999...
+    return int(decimal.Decimal(repr(value)).scaleb(digits).to_integral_value(decimal.ROUND_HALF_EVEN))
+
+
+def _starling(account, p):
+    event_time = _epoch(p['transactionTime'])
+    return Record(
+        bank='starling',
+        id=p['feedItemUid'],
+        account=account,
+        minor_units=p['amount']['minorUnits'] * (1 if p['direction'] == 'IN' else -1),
+        currency=p['amount']['currency'],
+        status=p['status'],
+        event_time=event_time,
+        update_time=_epoch(p['updatedAt']) if 'updatedAt' in p else event_time,
+        # Incoming SWIFT apparently has no counterPartyName.
+        counterparty=p.get('counterPartyName') or p.get('reference'),
+    )
+
+
+def _monzo(account, p):
+    event_time = _epoch(p['created'])
+    if 'decline_reason' in p:
+        status = 'DECLINED'
+    elif p.get('settled'):
+        status = 'SETTLED'
+    else:
+        status = 'PENDING'
+    merchant = p.get('merchant')
+    return Record(
+        bank='monzo',
+        id=p['id'],
+        account=account,
+        minor_units=p['amount'],
+        currency=p['currency'],
+        status=status,
+        event_time=event_time,
+        update_time=_epoch(p['updated']) if p.get('updated') else event_time,
+        counterparty=(merchant.get('name') if isinstance(merchant, dict) else None) or p.get('description'),
+    )
+
+
+def _wise(account, p):
+    # Statements only have completed transactions, and no update times.
+    event_time = _epoch(p['date'])
+    return Record(
+        bank='wise',
+        id=p['referenceNumber'],
+        account=account,
+        minor_units=minor_units(p['amount']['value'], p['amount']['currency']),
+        currency=p['amount']['currency'],
+        status='SETTLED',
+        event_time=event_time,
+        update_time=event_time,
+        counterparty=p.get('details', {}).get('description'),
+    )
+
+
+NORMALIZERS = {
+    'starling': _starling,
+    'monzo': _monzo,
+    'wise': _wise,
+}
+
+
+def bank_of(payload):
+    """Which bank a payload is from, telling by its fields."""
+    if 'feedItemUid' in payload:
+        return 'starling'
+    if 'referenceNumber' in payload:
+        return 'wise'
+    return 'monzo'
+
+
+def normalize(account, payload):
+    """The Record for a payload from any bank."""
+    return NORMALIZERS[bank_of(payload)](account, payload)
+
+
+def text(payload):
+    """Every piece of free text in a payload from any bank, some maybe None.
+
+    The counterparty comes first.
+    """
+    bank = bank_of(payload)
+    if bank == 'starling':
+        return [payload.get('counterPartyName'), payload.get('reference')]
+    if bank == 'wise':
+        return [payload.get('details', {}).get('description'), payload['referenceNumber']]
+    # Monzo's merchant is a bare id unless it was expanded.
+    merchant = payload.get('merchant')
+    return [
+        merchant.get('name') if isinstance(merchant, dict) else None,
+        payload.get('description'),
+        payload.get('notes'),
+    ]
+
+
+def counts_towards_balance(record):
+    """Same as amount() in starling/audit.py and monzo/audit.py."""
+    return record.status != 'DECLINED'
+
+
+def load_repo(bank, path, has_categories):
+    """Records for the latest version of every transaction in one repo."""
+    normalize = NORMALIZERS[bank]
+    records = []
+    for account_name, account in bankrepo.read_repo(path, has_categories).items():
+        for category_name, category in account.items():
+            if category_name is None:
+                account_id = account_name
+            else:
+                account_id = '%s/%s' % (account_name, category_name)
+            for versions in category.values():
+                records.append(normalize(account_id, versions[-1].payload))
+    return records
+
+
+def load(repos=None):
+    """Records from every repo, in time order.
+
+    repos maps each bank name to (path, has_categories), like REPOS.
+    Reading a repo is mostly parsing, so each is read in its own process.
+    """
+    if repos is None:
+        repos = REPOS
+    records = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(repos)) as executor:
+        futures = [
+            executor.submit(load_repo, bank, os.path.expanduser(path), has_categories)
+            for bank, (path, has_categories) in sorted(repos.items())
+        ]
+        for future in futures:
+            records.extend(future.result())
+    records.sort(key=lambda r: (r.event_time, r.bank, r.id))
+    return records
+
+
+def balances(records):
+    """{(bank, account, currency): minor units}"""
+    result = collections.defaultdict(int)
+    for r in records:
+        if counts_towards_balance(r):
+            result[(r.bank, r.account, r.currency)] += r.minor_units
+    return dict(result)
+
+
+def cash_flow(records, period='%Y-%m'):
+    """[(period, currency, money in, money out)] in order.
+
+    period is a strftime format naming the period of each record's time.
+    """
+    totals = collections.OrderedDict()
+    for r in records:
+        if not counts_towards_balance(r):
+            continue
+        key = (datetime.datetime.utcfromtimestamp(r.event_time).strftime(period), r.currency)
+        t = totals.setdefault(key, [0, 0])
+        t[0 if r.minor_units > 0 else 1] += r.minor_units
+    return [(p, c, t[0], t[1]) for (p, c), t in sorted(totals.items())]
+
+
+def main():
+    period = '%Y-%m'
+    repos = {}
+    for arg in sys.argv[1:]:
+        if arg == '--daily':
+            period = '%Y-%m-%d'
+        elif '=' in arg:
+            bank, path = arg.split('=', 1)
+            if bank not in REPOS:
+                raise RuntimeError('Unknown bank ' + bank)
+            repos[bank] = (path, REPOS[bank][1])
+        else:
+            raise RuntimeError('Usage: %s [--daily] [BANK=REPO...]' % sys.argv[0])
+    for p, currency, money_in, money_out in cash_flow(load(repos or None), period):
+        print('%-10s  %12s  %12s  %12s' % (
+            p,
+            lib.pretty_amount(money_in, currency),
+            lib.pretty_amount(money_out, currency),
+            lib.pretty_amount(money_in + money_out, currency)))
+
+
+if __name__ == '__main__':
+    main()
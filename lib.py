@@ -1,11 +1,54 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import contextlib
 import datetime
+import os
+import time
 
 
 def parse_iso8601(d):
-    return datetime.datetime.strptime(d, "%Y-%m-%dT%H:%M:%S.%fZ")
+    """A naive UTC datetime from an ISO 8601 UTC time, with or without
+    fractional seconds and the Z."""
+    t = d.rstrip('Z')
+    for fmt in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(t, fmt)
+        except ValueError:
+            pass
+    raise ValueError('Bad time ' + d)
+
+
+def format_iso8601(t):
+    """A naive UTC datetime in ISO 8601, to the millisecond, as the banks give times."""
+    return t.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (t.microsecond // 1000)
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode="w", umask=None):
+    """Write a new version of filename through the file this yields.
+
+    The file is a temporary one next to filename, which replaces it
+    only once the block completes without raising, so readers see
+    either the old or the new version whole. With umask, it is used
+    when creating the temporary file.
+    """
+    tmpfile = "%s.new.%d.%d" % (filename, time.time(), os.getpid())
+    if umask is not None:
+        umask = os.umask(umask)
+    try:
+        f = open(tmpfile, mode)
+    finally:
+        if umask is not None:
+            os.umask(umask)
+    try:
+        with f:
+            yield f
+    except BaseException:
+        os.unlink(tmpfile)
+        raise
+    os.rename(tmpfile, filename)
+
 
 def pretty_amount(amount, currency, declined=False):
     paren = ('(', ')') if declined else ('', ' ')
@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""A local stand-in for the bank APIs, serving synthetic transactions.
+
+Speaks the subset of the Starling, Monzo and Wise APIs that the fetchers
+use, including Wise's 2FA challenge, over plain HTTP. Point an API class
+at it by overriding HOSTNAME, PORT and HTTPS.
+
+It can also fail like the real ones do: a fraction of requests can get
+an error status (429 by default, with a Retry-After header if asked for)
+and a fraction can have the connection dropped without any response.
+
+Usage: mockbank.py [--error-rate=fraction] [--error-status=status]
+                   [--retry-after=seconds] [--drop-rate=fraction]
+                   [port [history_size [latency]]]
+"""
+
+import datetime
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import lib
+
+
+STARLING_ACCOUNT = str(uuid.UUID(int=1))
+MONZO_ACCOUNT = 'acc_00000001'
+WISE_PROFILE = 1
+WISE_ACCOUNT = 2
+WISE_CURRENCY = 'GBP'
+
+# Time between synthetic transactions.
+SPACING = datetime.timedelta(hours=6)
+
+# The Wise 2FA challenge we hand out, and which must come back.
+WISE_2FA_TOKEN = 'mock-2fa-token'
+
+
+class MockBank(object):
+    """Synthetic transaction history shared by the three APIs.
+
+    Starts with <history_size> settled transactions, one every SPACING
+    up to now. advance() makes the history move on between fetches.
+    """
+
+    def __init__(self, history_size, seed=0):
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.transactions = []
+        now = datetime.datetime.utcnow()
+        for i in range(history_size):
+            self._add(now - SPACING * (history_size - i))
+
+    def _add(self, when):
+        n = len(self.transactions)
+        self.transactions.append({
+            'n': n,
+            'time': when,
+            'updated': when + datetime.timedelta(seconds=self.random.randint(1, 60)),
+            'minor_units': self.random.randint(1, 100000),
+            'direction': self.random.choice(('IN', 'OUT')),
+            'name': 'Counterparty %d' % self.random.randint(1, 50),
+            'reference': 'REF%06d' % n,
+        })
+
+    def advance(self, updated, added):
+        """Touch the last <updated> transactions and add <added> new ones."""
+        with self.lock:
+            now = datetime.datetime.utcnow()
+            for t in self.transactions[-updated:] if updated else ():
+                t['updated'] = now
+            for i in range(added):
+                self._add(now - datetime.timedelta(seconds=added - i))
+
+    def starling_feed(self, since):
+        with self.lock:
+            return [self._starling_item(t) for t in self.transactions if t['updated'] >= since]
+
+    def _starling_item(self, t):
+        amount = {'currency': 'GBP', 'minorUnits': t['minor_units']}
+        return {
+            'feedItemUid': str(uuid.UUID(int=(1 << 64) + t['n'])),
+            'categoryUid': STARLING_ACCOUNT,
+            'amount': amount,
+            'sourceAmount': amount,
+            'direction': t['direction'],
+            'updatedAt': lib.format_iso8601(t['updated']),
+            'transactionTime': lib.format_iso8601(t['time']),
+            'settlementTime': lib.format_iso8601(t['updated']),
+            'source': 'FASTER_PAYMENTS_IN' if t['direction'] == 'IN' else 'FASTER_PAYMENTS_OUT',
+            'status': 'SETTLED',
+            'counterPartyName': t['name'],
+            'reference': t['reference'],
+            'spendingCategory': 'GENERAL',
+        }
+
+    def monzo_transactions(self, since, limit):
+        with self.lock:
+            items = [self._monzo_item(t) for t in self.transactions]
+        if since is not None:
+            if since.startswith('tx_'):
+                items = [i for i in items if i['id'] > since]
+            else:
+                items = [i for i in items if i['created'] >= lib.format_iso8601(lib.parse_iso8601(since))]
+        return items[:limit]
+
+    def _monzo_item(self, t):
+        sign = 1 if t['direction'] == 'IN' else -1
+        return {
+            'id': 'tx_%08d' % t['n'],
+            'account_id': MONZO_ACCOUNT,
+            'amount': sign * t['minor_units'],
+            'currency': 'GBP',
+            'created': lib.format_iso8601(t['time']),
+            'updated': lib.format_iso8601(t['updated']),
+            'settled': lib.format_iso8601(t['updated']),
+            'description': t['name'].upper(),
+            'merchant': None,
+            'notes': t['reference'],
+        }
+
+    def wise_statement(self, start, end):
+        with self.lock:
+            return [self._wise_item(t) for t in self.transactions if start <= t['time'] <= end]
+
+    def _wise_item(self, t):
+        sign = 1 if t['direction'] == 'IN' else -1
+        return {
+            'type': 'CREDIT' if t['direction'] == 'IN' else 'DEBIT',
+            'date': lib.format_iso8601(t['time']),
+            'amount': {'value': sign * t['minor_units'] / 100.0, 'currency': WISE_CURRENCY},
+            'totalFees': {'value': 0.0, 'currency': WISE_CURRENCY},
+            'details': {'type': 'TRANSFER', 'description': t['name']},
+            'runningBalance': {'value': 0.0, 'currency': WISE_CURRENCY},
+            'referenceNumber': 'TRANSFER-%d' % t['n'],
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None, headers=()):
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _fail(self):
+        """Maybe fail the request as asked. Returns whether it did."""
+        server = self.server
+        x = server.random.random()
+        if x < server.drop_rate:
+            server.dropped += 1
+            self.close_connection = True
+            return True
+        if x < server.drop_rate + server.error_rate:
+            server.errors += 1
+            headers = ()
+            if server.retry_after is not None:
+                headers = (('Retry-After', str(server.retry_after)),)
+            self._send(server.error_status, {'error': 'injected failure'}, headers)
+            return True
+        return False
+
+    def do_GET(self):
+        self.server.requests += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self._fail():
+            return
+        bank = self.server.bank
+        url = urlparse(self.path)
+        q = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        path = url.path.strip('/').split('/')
+
+        # Starling
+        if path == ['api', 'v2', 'accounts']:
+            return self._send(200, {'accounts': [
+                {'accountUid': STARLING_ACCOUNT, 'defaultCategory': STARLING_ACCOUNT}]})
+        if path[:3] == ['api', 'v2', 'account'] and path[4:] == ['spaces']:
+            return self._send(200, {'savingsGoals': []})
+        if path[:4] == ['api', 'v2', 'feed', 'account'] and len(path) == 7:
+            since = lib.parse_iso8601(q.get('changesSince', '1970-01-01T00:00:00Z'))
+            return self._send(200, {'feedItems': bank.starling_feed(since)})
+
+        # Monzo
+        if path == ['accounts']:
+            return self._send(200, {'accounts': [{'id': MONZO_ACCOUNT}]})
+        if path == ['transactions']:
+            return self._send(200, {'transactions': bank.monzo_transactions(
+                q.get('since'), int(q.get('limit', 100)))})
+
+        # Wise
+        if path == ['v1', 'borderless-accounts']:
+            return self._send(200, [
+                {'id': WISE_ACCOUNT, 'balances': [{'currency': WISE_CURRENCY}]}])
+        if path[:2] == ['v3', 'profiles'] and path[-1] == 'statement.json':
+            if self.headers.get('X-2FA-Approval') != WISE_2FA_TOKEN or not self.headers.get('X-Signature'):
+                return self._send(403, {'error': '2FA required'}, (
+                    ('x-2fa-approval-result', 'REJECTED'),
+                    ('x-2fa-approval', WISE_2FA_TOKEN),
+                ))
+            return self._send(200, {
+                'accountHolder': {'type': 'PERSONAL'},
+                'transactions': bank.wise_statement(
+                    lib.parse_iso8601(q['intervalStart']), lib.parse_iso8601(q['intervalEnd'])),
+                'endOfStatementBalance': {'value': 0.0, 'currency': WISE_CURRENCY},
+            })
+
+        self._send(404, {'error': 'not found'})
+
+
+def make_server(bank, port=0, latency=0, error_rate=0, error_status=429,
+                retry_after=None, drop_rate=0, seed=0):
+    """An HTTP server for <bank>, not yet serving.
+
+    <latency> seconds are added to every request. Use port 0 for any
+    free port; the one chosen is in server.server_port.
+
+    A fraction <error_rate> of requests get <error_status>, with a
+    Retry-After header of <retry_after> seconds unless that is None, and
+    a fraction <drop_rate> have their connection closed unanswered.
+    server.errors and server.dropped count them.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    server.bank = bank
+    server.latency = latency
+    server.error_rate = error_rate
+    server.error_status = error_status
+    server.retry_after = retry_after
+    server.drop_rate = drop_rate
+    server.random = random.Random(seed)
+    server.requests = 0
+    server.errors = 0
+    server.dropped = 0
+    return server
+
+
+def main():
+    options = {}
+    args = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--error-rate='):
+            options['error_rate'] = float(arg.split('=', 1)[1])
+        elif arg.startswith('--error-status='):
+            options['error_status'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--retry-after='):
+            options['retry_after'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--drop-rate='):
+            options['drop_rate'] = float(arg.split('=', 1)[1])
+        else:
+            args.append(arg)
+    port = int(args[0]) if len(args) > 0 else 8080
+    history_size = int(args[1]) if len(args) > 1 else 1000
+    latency = float(args[2]) if len(args) > 2 else 0
+    make_server(MockBank(history_size), port, latency, **options).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
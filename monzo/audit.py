@@ -24,15 +24,22 @@ def dump_item(item):
 def item_time(item):
     return max(version.payload['created'] for version in item)
 
+def amount(payload):
+    """(currency, signed minor units) counting towards the balance, or None."""
+    if 'decline_reason' in payload:
+        return None
+    return payload['currency'], payload['amount']
+
 def dump_account(feed_items):
     violations = False
     balance = 0
     currencies = set()
     for item in sorted(feed_items.values(), key=item_time):
         dump_item(item)
-        if 'decline_reason' not in item[-1].payload:
-            currencies.add(item[-1].payload['currency'])
-            balance += item[-1].payload['amount']
+        a = amount(item[-1].payload)
+        if a is not None:
+            currencies.add(a[0])
+            balance += a[1]
     if len(currencies) > 1:
         print(' Account has multiple currencies!')
     if currencies:
@@ -7,28 +7,59 @@
 #  import monzo.fetch
 #  monzo.fetch.main()
 
+import datetime
 import errno
 import json
 import os
 import re
-import subprocess
+import sys
 
 import fetch_base
+import lib
 
 
+PROJECT_DIR = "~/projects/monzo"
+TOKEN_FILE = PROJECT_DIR + "/oauthtoken"
+
+# Items are committed as <account>/<transaction id>.
+ITEM_DEPTH = 2
+
+# Transactions per page. This is the maximum that the API allows.
+PAGE_LIMIT = 100
+
+# Routine runs restart this long before the latest transaction already
+# seen, since pending transactions can still change until they settle.
+PENDING_OVERLAP = datetime.timedelta(days=14)
+
 _SANITY_RE = re.compile(r'^[0-9a-zA-Z_-]+$')
 
 
 class MonzoAPI(fetch_base.BankAPI):
     HOSTNAME = "api.monzo.com"
 
-    def __init__(self):
-        with open(os.path.expanduser("../oauthtoken")) as f:
-            params = json.load(f)
-        self.token = params['access_token']
+    _token = None
+    _token_mtime = None
+
+    @property
+    def token(self):
+        """The access token, reread whenever monzo-oauth replaces it."""
+        filename = os.path.expanduser(TOKEN_FILE)
+        mtime = os.stat(filename).st_mtime
+        if mtime != self._token_mtime:
+            with open(filename) as f:
+                params = json.load(f)
+            self._token = params['access_token']
+            self._token_mtime = mtime
+        return self._token
 
 
-def feed(api, account_id):
+def feed(api, account_id, cursor=None):
+    """Fetch transactions created since cursor, or all if it is None.
+
+    Pages through the results using the id of the last transaction
+    on each page. Returns the latest 'created' time seen, to be used
+    as the next cursor.
+    """
     if not _SANITY_RE.match(account_id):
         raise RuntimeError('Bad account')
     try:
@@ -36,27 +67,52 @@ def feed(api, account_id):
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
-    r = api("/transactions?expand[]=merchant&account_id=" + account_id)
-    items = r['transactions']
-    for item in items:
-        item_id = item['id']
-        if not _SANITY_RE.match(item_id):
-            raise RuntimeError('Bad feed item UID')
-        fn = "%s/%s" % (account_id, item_id)
-        with open(fn, "w") as f:
-            json.dump(item, f, indent=2, sort_keys=True)
-        subprocess.check_call(('git', 'add', fn))
-
-
-def import_monzo():
-    api = MonzoAPI()
+    since = None
+    if cursor is not None:
+        since = lib.format_iso8601(lib.parse_iso8601(cursor) - PENDING_OVERLAP)
+    latest = cursor
+    while True:
+        url = "/transactions?expand[]=merchant&account_id=%s&limit=%d" % (
+            account_id, PAGE_LIMIT)
+        if since is not None:
+            url += "&since=" + since
+        count = 0
+        for item in api.stream(url, 'transactions'):
+            count += 1
+            item_id = item['id']
+            if not _SANITY_RE.match(item_id):
+                raise RuntimeError('Bad feed item UID')
+            fn = fetch_base.item_path(account_id, item_id)
+            fetch_base.stage(fn, item)
+            if latest is None or item['created'] > latest:
+                latest = item['created']
+        if count < PAGE_LIMIT:
+            return latest
+        since = item_id
+
+
+def import_monzo(cursors, full=False, api=None):
+    if api is None:
+        api = MonzoAPI()
     r = api("/accounts")
     accounts = r['accounts']
     for account in accounts:
         id = account['id']
-        feed(api, id)
+        cursors[id] = feed(api, id, None if full else cursors.get(id))
+
+
+def run(api=None, full=False, project_dir=PROJECT_DIR, layout=None):
+    # There is no periodic full crawl because Monzo only gives access
+    # to more than 90 days of history shortly after authentication.
+    # Use --full just after "monzo-oauth --new".
+    with fetch_base.fetcher_main(project_dir, write_metrics=True, item_depth=ITEM_DEPTH) as state:
+        if layout is not None:
+            fetch_base.set_layout(state, layout)
+        fetch_base.fetch(lambda: import_monzo(
+            state.setdefault('cursors', {}), full, api))
+    fetch_base.push(project_dir)
+    fetch_base.maintain(project_dir)
 
 
 def main():
-    with fetch_base.fetcher_main("~/projects/monzo"):
-        fetch_base.fetch(import_monzo)
+    run(full='--full' in sys.argv[1:], layout=fetch_base.layout_arg())
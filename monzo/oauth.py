@@ -8,13 +8,22 @@
 #  monzo.oauth.main()
 
 import json
-import httplib
 import os
 import sys
 import time
-import urllib
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
 
 import fetch_base
+import lib
+import monzo.fetch
+from fetch_base import httplib
+
+
+# Refresh the access token this long before it expires.
+REFRESH_MARGIN = 30 * 60
 
 
 CLIENT_ID = 'oauth2client_00009mHeBn5bAVvUPAMopF'
@@ -46,35 +55,49 @@ def get_token(code):
 
 
 def call_oauth(params):
-    conn = httplib.HTTPSConnection("api.monzo.com", 443)
+    # This runs holding the fetch lock, so don't let it hang.
+    conn = httplib.HTTPSConnection("api.monzo.com", 443, timeout=fetch_base.request_timeout())
     headers = {
         "User-Agent": "https://github.com/vandry/banks",
         "Content-Type": "application/x-www-form-urlencoded",
     }
-    conn.request("POST", "/oauth2/token", urllib.urlencode(params), headers)
+    conn.request("POST", "/oauth2/token", urlencode(params), headers)
     r = conn.getresponse()
     if r.status != 200:
         raise RuntimeError('%d %s %s' % (r.status, r.reason, r.read()))
-    return r.read()
+    return r.read().decode('utf-8')
+
+
+def save_token(token):
+    with lib.atomic_write(os.path.expanduser(monzo.fetch.TOKEN_FILE), umask=0o077) as f:
+        f.write(token)
+
+
+def refresh():
+    """Replace the current token with a fresh one."""
+    with fetch_base.fetcher_main(monzo.fetch.PROJECT_DIR):
+        with open(os.path.expanduser(monzo.fetch.TOKEN_FILE)) as f:
+            old_token = json.load(f)
+        save_token(refresh_token(old_token['refresh_token']))
+
+
+def refresh_due():
+    """Seconds until the current token should be refreshed."""
+    filename = os.path.expanduser(monzo.fetch.TOKEN_FILE)
+    with open(filename) as f:
+        token = json.load(f)
+    expiry = os.stat(filename).st_mtime + token['expires_in']
+    return expiry - REFRESH_MARGIN - time.time()
 
 
 def main():
     if len(sys.argv) != 2:
         raise RuntimeError('Usage: --new or --refresh')
     if sys.argv[1] == '--refresh':
-        code = None
+        refresh()
     elif sys.argv[1] == '--new':
         code = sys.stdin.read()
-
-    with fetch_base.fetcher_main("~/projects/monzo"):
-        if code is None:  # refresh existing code
-            with open("../oauthtoken") as f:
-                old_token = json.load(f)
-            token = refresh_token(old_token['refresh_token'])
-        else:
-            token = get_token(code)
-        tmpfile = "../oauthtoken.new.%d.%d" % (time.time(), os.getpid())
-        os.umask(0o077)
-        with open(tmpfile, "w") as f:
-            f.write(token)
-        os.rename(tmpfile, "../oauthtoken")
+        with fetch_base.fetcher_main(monzo.fetch.PROJECT_DIR):
+            save_token(get_token(code))
+    else:
+        raise RuntimeError('Usage: --new or --refresh')
@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Search transactions by counterparty, reference, amount and time.
+
+Keeps an index over a bankrepo history, in a file inside the git dir,
+and brings it up to date with the new commits before each search.
+
+Usage: search.py [--substring] [--min=AMOUNT] [--max=AMOUNT]
+                 [--since=YYYY-MM-DD] [--until=YYYY-MM-DD] REPO [WORDS...]
+
+Amounts are signed minor units. Every word must appear (as the start of
+a word, or with --substring anywhere in one) in the counterparty,
+reference, description or merchant name of some version of the
+transaction. Times are UTC.
+"""
+
+import argparse
+import bisect
+import datetime
+import json
+import mmap
+import os
+import re
+import pygit2
+
+import bankrepo
+import ledger
+import lib
+
+
+INDEX_FILE = 'bank-search-index.json'
+INDEX_VERSION = 5
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def fields(payload):
+    """(text, signed minor units, currency, time) of any bank's transaction."""
+    record = ledger.normalize(None, payload)
+    time = datetime.datetime.utcfromtimestamp(record.event_time).strftime('%Y-%m-%dT%H:%M:%S')
+    return ledger.text(payload), record.minor_units, record.currency, time
+
+
+def _words(text):
+    return set(w.lower() for t in text if t for w in _WORD_RE.findall(t))
+
+
+# The index file is a header line, then one JSON document per line: each
+# of _SECTIONS, then the ids for each word, then the row for each id. The
+# header has where each line starts, counting from the end of the header.
+_SECTIONS = ('words', 'amounts', 'amount_ids', 'times', 'time_ids')
+# What each row holds.
+_ROW_FIELDS = ('key', 'amount', 'currency', 'time', 'description', 'blob', 'commit')
+
+
+def _dump(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+class _MappedLines(object):
+    """Lines of an index file, by number, read only when asked for."""
+
+    def __init__(self, data, base, offsets):
+        self.data = data
+        self.base = base
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        start = self.base + self.offsets[i]
+        return self.data[start:self.base + self.offsets[i + 1] - 1].decode('utf-8')
+
+
+class SearchIndex(object):
+    """Inverted word index plus amount and time indexes.
+
+    Each transaction (keyed account[/category]/name) has an id, and a
+    row with its latest amount, currency and time and the blob and
+    commit where it was last changed. words is every word from any
+    version, sorted, each with the ids it appears in. amounts and times
+    are sorted, with the ids in the same order in amount_ids and
+    time_ids.
+
+    All of these are kept as the lines of the index file, and each is
+    only parsed when a search needs it, so that loading the index and
+    searching it is a few binary searches rather than a pass over
+    every transaction.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.head = None
+        # ({key: id}, rows, {word: set of ids}) while updating.
+        self._unpacked = ({}, [], {})
+        self._pack()
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return index
+        with f:
+            try:
+                header = json.loads(f.readline().decode('utf-8'))
+            except ValueError:
+                return index
+            if header.get('version') != INDEX_VERSION:
+                return index
+            offsets = header['offsets']
+            if len(offsets) != len(_SECTIONS) + header['words'] + header['count'] + 1:
+                return index
+            base = f.tell()
+            if os.fstat(f.fileno()).st_size != base + offsets[-1]:
+                return index
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index.head = header['head']
+        index._nwords = header['words']
+        index._count = header['count']
+        index._lines = _MappedLines(data, base, offsets)
+        index._parsed = {}
+        index._unpacked = None
+        return index
+
+    def save(self, filename):
+        lines = [self._lines[i].encode('utf-8') + b'\n' for i in range(len(self._lines))]
+        offsets = [0]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line))
+        with lib.atomic_write(filename, "wb") as f:
+            f.write(_dump({
+                'version': INDEX_VERSION,
+                'head': self.head,
+                'words': self._nwords,
+                'count': self._count,
+                'offsets': offsets,
+            }).encode('utf-8') + b'\n')
+            f.writelines(lines)
+
+    def _get(self, section):
+        try:
+            return self._parsed[section]
+        except KeyError:
+            value = self._parsed[section] = json.loads(self._lines[_SECTIONS.index(section)])
+            return value
+
+    def _postings(self, i):
+        return json.loads(self._lines[len(_SECTIONS) + i])
+
+    def _row(self, i):
+        return json.loads(self._lines[len(_SECTIONS) + self._nwords + i])
+
+    def _unpack(self):
+        """The index in a form to change; see clear()."""
+        if self._unpacked is None:
+            rows = [self._row(i) for i in range(self._count)]
+            self._unpacked = (
+                dict((row[0], i) for i, row in enumerate(rows)),
+                rows,
+                dict((w, set(self._postings(i))) for i, w in enumerate(self._get('words'))),
+            )
+        return self._unpacked
+
+    def _pack(self):
+        ids, rows, word_ids = self._unpacked
+        words = sorted(word_ids)
+        by_amount = sorted(range(len(rows)), key=lambda i: (rows[i][1], rows[i][0]))
+        by_time = sorted(range(len(rows)), key=lambda i: (rows[i][3], rows[i][0]))
+        self._lines = [
+            _dump(words),
+            _dump([rows[i][1] for i in by_amount]),
+            _dump(by_amount),
+            _dump([rows[i][3] for i in by_time]),
+            _dump(by_time),
+        ]
+        self._lines.extend(_dump(sorted(word_ids[w])) for w in words)
+        self._lines.extend(_dump(row) for row in rows)
+        self._nwords = len(words)
+        self._count = len(rows)
+        self._parsed = {}
+        self._unpacked = None
+
+    def update(self, repo):
+        """Index the commits since the last update. Returns how many."""
+        head, commits, rewritten = bankrepo.new_commits(repo, self.head)
+        if rewritten:
+            self.clear()
+        n = 0
+        for commit in commits:
+            for path, old_id, blob_id in bankrepo.changed_files(repo, commit):
+                directory = bankrepo.mailbox_dir(path)
+                if not directory:
+                    continue
+                key = '%s/%s' % (directory, path.rsplit('/', 1)[-1])
+                self._add(key, repo[blob_id], commit)
+            n += 1
+        self.head = str(head)
+        if self._unpacked is not None:
+            self._pack()
+        return n
+
+    def _add(self, key, blob, commit):
+        payload = json.loads(blob.data.decode('utf-8'))
+        text, minor_units, currency, time = fields(payload)
+        ids, rows, word_ids = self._unpack()
+        row = [key, minor_units, currency, time, next((t for t in text if t), ''),
+               str(blob.id), str(commit.id)]
+        i = ids.get(key)
+        if i is None:
+            i = ids[key] = len(rows)
+            rows.append(row)
+        else:
+            rows[i] = row
+        for word in _words(text):
+            word_ids.setdefault(word, set()).add(i)
+
+    def _word_ids(self, word, substring):
+        words = self._get('words')
+        if substring:
+            matches = [i for i, w in enumerate(words) if word in w]
+        else:
+            matches = range(bisect.bisect_left(words, word),
+                            bisect.bisect_left(words, word + '\uffff'))
+        ids = set()
+        for i in matches:
+            ids.update(self._postings(i))
+        return ids
+
+    def search(self, words=(), min_amount=None, max_amount=None, since=None, until=None,
+               substring=False):
+        """(key, transaction) of the matching transactions, in time order.
+
+        Each transaction is a dict of its amount, currency, time,
+        description, blob and commit. Each word matches the words that
+        start with it, or with substring, that contain it (which looks
+        at every word). since and until are ISO 8601 prefixes, e.g.
+        '2021-03' or '2021-03-04T12:00'; until is inclusive of the whole
+        prefix.
+        """
+        result = None
+        for word in words:
+            ids = self._word_ids(word.lower(), substring)
+            result = ids if result is None else result & ids
+        if min_amount is not None or max_amount is not None:
+            amounts = self._get('amounts')
+            lo = 0 if min_amount is None else bisect.bisect_left(amounts, min_amount)
+            hi = len(amounts) if max_amount is None else bisect.bisect_right(amounts, max_amount)
+            ids = set(self._get('amount_ids')[lo:hi])
+            result = ids if result is None else result & ids
+        if since is not None or until is not None:
+            times = self._get('times')
+            lo = 0 if since is None else bisect.bisect_left(times, since)
+            hi = len(times) if until is None else bisect.bisect_left(times, until + '\uffff')
+            ids = set(self._get('time_ids')[lo:hi])
+            result = ids if result is None else result & ids
+        if result is None:
+            result = range(self._count)
+        rows = sorted((self._row(i) for i in result), key=lambda row: (row[3], row[0]))
+        return [(row[0], dict(zip(_ROW_FIELDS[1:], row[1:]))) for row in rows]
+
+
+def open_index(repo_path):
+    """The up to date index for the repo at repo_path."""
+    repo = pygit2.Repository(repo_path)
+    filename = os.path.join(repo.path, INDEX_FILE)
+    index = SearchIndex.load(filename)
+    if index.update(repo):
+        index.save(filename)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search bank transactions.')
+    parser.add_argument('--substring', action='store_true',
+                        help='match words anywhere within words, not just at the start')
+    parser.add_argument('--min', type=int, help='minimum signed amount in minor units')
+    parser.add_argument('--max', type=int, help='maximum signed amount in minor units')
+    parser.add_argument('--since', help='earliest time, e.g. 2021-03-04')
+    parser.add_argument('--until', help='latest time, e.g. 2021-03-04')
+    parser.add_argument('repo')
+    parser.add_argument('words', nargs='*')
+    args = parser.parse_args()
+
+    index = open_index(os.path.expanduser(args.repo))
+    for key, t in index.search(args.words, args.min, args.max, args.since, args.until,
+                               args.substring):
+        print('%s  %12s  %s  %s' % (
+            t['time'][:16], lib.pretty_amount(t['amount'], t['currency']), t['description'], key))
+
+
+if __name__ == '__main__':
+    main()
@@ -71,6 +71,8 @@ TIMESTAMP_GRACE_PERIOD = datetime.timedelta(seconds=33)
 # update that occurred between those two times must have been present
 # in the commit even if its update time is earlier than the commit.
 # As of 2020-06-21 the fetch script runs for about 18 seconds.
+# The fetcher now reports how long each run takes, as
+# bank_fetch_run_seconds in ~/projects/starling/fetch.prom.
 COMMIT_GRACE_PERIOD = datetime.timedelta(seconds=35)
 
 # Transactions must be seen by us at most this amount of time
@@ -390,6 +392,81 @@ def deep_compare(a, b, ignore_parts):
             changes.append('')
     return changes
 
+def check_version(version, prev_payload, transaction_time):
+    """Check one version of a transaction against the previous one.
+
+    prev_payload is None for the first version. Returns lists of
+    violations and of warnings.
+    """
+    violations = []
+    warnings = []
+    payload = version.payload
+
+    if payload['direction'] not in ('IN', 'OUT'):
+        violations.append('unrecognized direction %s' % payload['direction'])
+    if payload['status'] in ('PENDING', 'UPCOMING', 'DECLINED', 'REVERSED'):
+        if 'settlementTime' in payload:
+            violations.append(payload['status'] + ' transaction has a settlementTime')
+    elif payload['status'] == 'SETTLED':
+        if 'settlementTime' not in payload:
+            violations.append('SETTLED transaction has no settlementTime')
+    else:
+        violations.append('unrecognized status %s' % payload['status'])
+
+    update_time = lib.parse_iso8601(payload['updatedAt'])
+    if update_time < version.prev_commit_time - COMMIT_GRACE_PERIOD:
+        violations.append('transaction was updated at %s while transactions updated before %s should have been covered in a parent commit' % (
+            update_time, version.prev_commit_time))
+    if update_time > version.commit_time + TIMESTAMP_GRACE_PERIOD:
+        violations.append('transaction with future date: it was updated at %s but committed at %s' % (
+            update_time, version.commit_time))
+    if (
+        update_time < version.commit_time - MaxCommitDelay.get_max(version)
+    ):
+        violations.append('Took too long (%s) to commit' % (version.commit_time - update_time))
+    if update_time > transaction_time + LastUpdateDelay.get_max(version):
+        violations.append('Transaction updated too late (%s)' % (update_time - transaction_time))
+    elif update_time > transaction_time + LastUpdateWarningDelay.get_max(version):
+        warnings.append('Updated quite a long time after the transaction (%s)' % (update_time - transaction_time))
+
+    if payload['status'] == 'UPCOMING':
+        if transaction_time < update_time - TIMESTAMP_GRACE_PERIOD:
+            violations.append('Upcoming transaction is not in the future')
+    else:
+        if transaction_time > update_time + TIMESTAMP_GRACE_PERIOD:
+            violations.append('Transaction time %s greater than update time %s' % (transaction_time, update_time))
+
+    if prev_payload is not None:
+        settling = prev_payload['status'] == 'PENDING' and payload['status'] == 'SETTLED'
+        if not StuffChangedExceptions.get_max(version):
+            ignorable = IGNORE_CHANGES
+            if settling:
+                ignorable = IGNORE_CHANGES_ON_SETTLEMENT
+            for c in deep_compare(prev_payload, payload, ignorable):
+                violations.append('%s changed between versions' % c)
+        # This actually happens, apparently legitimately, for unexplained reasons
+        # if len(deep_compare(prev_payload, payload, {'updatedAt': None})) == 0:
+        #     violations.append('updatedAt changed between versions with no other change')
+
+        if payload['updatedAt'] < prev_payload['updatedAt']:
+            violations.append('updatedAt went backwards')
+
+        settled = False
+        if settling:
+            settled = True
+        elif prev_payload['status'] == 'UPCOMING' and payload['status'] == 'SETTLED':
+            settled = True
+        elif prev_payload['status'] == 'UPCOMING' and payload['status'] == 'PENDING':
+            pass
+        elif prev_payload['status'] == 'PENDING' and payload['status'] == 'REVERSED':
+            pass
+        elif prev_payload['status'] != payload['status']:
+            violations.append('status went from %s to %s' % (prev_payload['status'], payload['status']))
+        if not settled:
+            if prev_payload.get('settlementTime', None) != payload.get('settlementTime', None):
+                violations.append('settlementTime changed without the transaction becoming settled')
+    return violations, warnings
+
 def dump_item(item):
     versionn = item[-1].payload
 
@@ -426,74 +503,10 @@ def dump_item(item):
             prev_payload = version.payload
             continue
 
-        violations = []
-        warnings = []
+        violations, warnings = check_version(version, prev_payload, transaction_time)
         payload = version.payload
 
-        if payload['direction'] not in ('IN', 'OUT'):
-            violations.append('unrecognized direction %s' % version['direction'])
-        if payload['status'] in ('PENDING', 'UPCOMING', 'DECLINED', 'REVERSED'):
-            if 'settlementTime' in payload:
-                violations.append(payload['status'] + ' transaction has a settlementTime')
-        elif payload['status'] == 'SETTLED':
-            if 'settlementTime' not in payload:
-                violations.append('SETTLED transaction has no settlementTime')
-        else:
-            violations.append('unrecognized status %s' % payload['status'])
-
-        update_time = lib.parse_iso8601(payload['updatedAt'])
-        if update_time < version.prev_commit_time - COMMIT_GRACE_PERIOD:
-            violations.append('transaction was updated at %s while transactions updated before %s should have been covered in a parent commit' % (
-                update_time, version.prev_commit_time))
-        if update_time > version.commit_time + TIMESTAMP_GRACE_PERIOD:
-            violations.append('transaction with future date: it was updated at %s but committed at %s' % (
-                update_time, version.commit_time))
-        if (
-            update_time < version.commit_time - MaxCommitDelay.get_max(version)
-        ):
-            violations.append('Took too long (%s) to commit' % (version.commit_time - update_time))
-        if update_time > transaction_time + LastUpdateDelay.get_max(version):
-            violations.append('Transaction updated too late (%s)' % (update_time - transaction_time))
-        elif update_time > transaction_time + LastUpdateWarningDelay.get_max(version):
-            warnings.append('Updated quite a long time after the transaction (%s)' % (update_time - transaction_time))
-
-        if payload['status'] == 'UPCOMING':
-            if transaction_time < update_time - TIMESTAMP_GRACE_PERIOD:
-                violations.append('Upcoming transaction is not in the future')
-        else:
-            if transaction_time > update_time + TIMESTAMP_GRACE_PERIOD:
-                violations.append('Transaction time %s greater than update time %s' % (transaction_time, update_time))
-
         if prev_payload is not None:
-            settling = prev_payload['status'] == 'PENDING' and payload['status'] == 'SETTLED'
-            if not StuffChangedExceptions.get_max(version):
-                ignorable = IGNORE_CHANGES
-                if settling:
-                    ignorable = IGNORE_CHANGES_ON_SETTLEMENT
-                for c in deep_compare(prev_payload, payload, ignorable):
-                    violations.append('%s changed between versions' % c)
-            # This actually happens, apparently legitimately, for unexplained reasons
-            # if len(deep_compare(prev_payload, payload, {'updatedAt': None})) == 0:
-            #     violations.append('updatedAt changed between versions with no other change')
-
-            if payload['updatedAt'] < prev_payload['updatedAt']:
-                violations.append('updatedAt went backwards')
-
-            settled = False
-            if settling:
-                settled = True
-            elif prev_payload['status'] == 'UPCOMING' and payload['status'] == 'SETTLED':
-                settled = True
-            elif prev_payload['status'] == 'UPCOMING' and payload['status'] == 'PENDING':
-                pass
-            elif prev_payload['status'] == 'PENDING' and payload['status'] == 'REVERSED':
-                pass
-            elif prev_payload['status'] != payload['status']:
-                violations.append('status went from %s to %s' % (prev_payload['status'], payload['status']))
-            if not settled:
-                if prev_payload.get('settlementTime', None) != payload.get('settlementTime', None):
-                    violations.append('settlementTime changed without the transaction becoming settled')
-
             if len(deep_compare(prev_payload['amount'], payload['amount'], {})) > 0:
                 old_amounts.append(prev_payload['amount'])
             if len(deep_compare(prev_payload['sourceAmount'], payload['sourceAmount'], {})) > 0:
@@ -532,6 +545,48 @@ def dump_item(item):
 def item_time(item):
     return max(version.payload['transactionTime'] for version in item)
 
+def amount(payload):
+    """(currency, signed minor units) counting towards the balance, or None."""
+    if payload['status'] == 'DECLINED':
+        return None
+    return payload['amount']['currency'], payload['amount']['minorUnits'] * (
+        1 if payload['direction'] == 'IN' else -1)
+
+def audit_changes(changes, prev_commit_time):
+    """Check the versions about to be committed by a fetch.
+
+    changes is a list of (path, previous payload or None, new payload),
+    as from fetch_base.staged_changes(), and prev_commit_time is the
+    commit time of HEAD (seconds since the epoch) or None. The versions
+    are checked as if committed now, the same as the full audit would
+    check them later. Returns lists of violations and of warnings.
+    """
+    commit_time = datetime.datetime.utcnow()
+    if prev_commit_time is None:
+        prev_commit_time = datetime.datetime(2000, 1, 1)
+    else:
+        prev_commit_time = datetime.datetime.utcfromtimestamp(prev_commit_time)
+    all_violations = []
+    all_warnings = []
+    for path, prev_payload, payload in changes:
+        version = bankrepo.Transaction(
+            payload=payload,
+            blob_id=None,
+            commit_id=None,
+            commit_time=commit_time,
+            prev_commit_time=prev_commit_time,
+        )
+        transaction_time = lib.parse_iso8601(payload['transactionTime'])
+        violations, warnings = check_version(version, prev_payload, transaction_time)
+        if prev_payload is None:
+            update_time = lib.parse_iso8601(payload['updatedAt'])
+            if update_time > transaction_time + FirstUpdateDelay.get_max(version):
+                violations.append('Transaction first updated too late (%s)' % (update_time - transaction_time))
+        uid = payload['feedItemUid']
+        all_violations.extend('%s: %s' % (uid, v) for v in violations)
+        all_warnings.extend('%s: %s' % (uid, w) for w in warnings)
+    return all_violations, all_warnings
+
 def dump_category(feed_items):
     violations = False
     balance = 0
@@ -539,10 +594,10 @@ def dump_category(feed_items):
     for item in sorted(feed_items.values(), key=item_time):
         if dump_item(item):
             violations = True
-        if item[-1].payload['status'] != 'DECLINED':
-            currencies.add(item[-1].payload['amount']['currency'])
-            balance += item[-1].payload['amount']['minorUnits'] * (
-                1 if item[-1].payload['direction'] == 'IN' else -1)
+        a = amount(item[-1].payload)
+        if a is not None:
+            currencies.add(a[0])
+            balance += a[1]
     if len(currencies) > 1:
         print(' Category has multiple currencies!')
         return True
@@ -7,15 +7,35 @@
 #  import starling.fetch
 #  starling.fetch.main()
 
+import datetime
 import errno
 import json
 import os
 import re
-import subprocess
+import sys
 
 import fetch_base
+import lib
 
 
+PROJECT_DIR = "~/projects/starling"
+
+# Items are committed as <account>/<category>/<feed item uid>.
+ITEM_DEPTH = 3
+
+# Ask only for changes since the most recent updatedAt we already have,
+# minus this much. The overlap must comfortably exceed the time between
+# the bank producing its snapshot and our commit (see COMMIT_GRACE_PERIOD
+# in audit.py) or an update that lands during that window could be missed
+# and the audit would find it "updated before parent commit" later on.
+WATERMARK_OVERLAP = datetime.timedelta(hours=1)
+
+# Refetch everything this often anyway, in case the bank changed
+# something without bumping updatedAt. Also done with --full.
+FULL_RESYNC_INTERVAL = datetime.timedelta(days=1)
+
+FEED_EPOCH = "2019-01-01T00:00:00.000Z"
+
 _UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
 
 
@@ -27,41 +47,95 @@ class StarlingAPI(fetch_base.BankAPI):
             self.token = f.read().strip()
 
 
-def feed(api, account_id, category):
+def latest_update(directory):
+    """Latest updatedAt in the committed feed items, or None if none."""
+    latest = None
+    for fn in fetch_base.item_files(directory):
+        with open(fn) as f:
+            updated = json.load(f)['updatedAt']
+        if latest is None or updated > latest:
+            latest = updated
+    return latest
+
+
+def watermark(latest):
+    """Where to fetch from, given the latest updatedAt committed."""
+    if latest is None:
+        return FEED_EPOCH
+    return lib.format_iso8601(lib.parse_iso8601(latest) - WATERMARK_OVERLAP)
+
+
+def feed(api, account_id, category, latest_updates, full=False):
+    """Fetch and stage the feed items changed since the last commit.
+
+    latest_updates (kept in the fetcher state, so only saved once the
+    commit is made) maps each category directory to the latest updatedAt
+    committed there. Without it the committed items are read to find it.
+    """
     if not _UUID_RE.match(account_id):
         raise RuntimeError('Bad account')
     if not _UUID_RE.match(category):
         raise RuntimeError('Bad category')
+    directory = "%s/%s" % (account_id, category)
     try:
-        os.makedirs("%s/%s" % (account_id, category))
+        os.makedirs(directory)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
-    r = api("/api/v2/feed/account/%s/category/%s?changesSince=%s" % (
-        account_id, category, "2019-01-01T00:00:00.000Z"))
-    items = r['feedItems']
+    if full:
+        latest = None
+        since = FEED_EPOCH
+    else:
+        latest = latest_updates.get(directory)
+        if latest is None:
+            latest = latest_update(directory)
+        since = watermark(latest)
+    # Items not returned are left as they were in the last commit.
+    items = api.stream("/api/v2/feed/account/%s/category/%s?changesSince=%s" % (
+        account_id, category, since), 'feedItems')
     for item in items:
         item_uid = item['feedItemUid']
         if not _UUID_RE.match(item_uid):
             raise RuntimeError('Bad feed item UID')
-        fn = "%s/%s/%s" % (account_id, category, item_uid)
-        with open(fn, "w") as f:
-            json.dump(item, f, indent=2, sort_keys=True)
-        subprocess.check_call(('git', 'add', fn))
+        fn = fetch_base.item_path(directory, item_uid)
+        fetch_base.stage(fn, item)
+        if latest is None or item['updatedAt'] > latest:
+            latest = item['updatedAt']
+    if latest is not None:
+        latest_updates[directory] = latest
 
 
-def import_starling():
-    api = StarlingAPI()
+def import_starling(latest_updates, full=False, api=None):
+    if api is None:
+        api = StarlingAPI()
     r = api("/api/v2/accounts")
     accounts = r['accounts']
     for account in accounts:
         account_id = account['accountUid']
-        feed(api, account_id, account['defaultCategory'])
+        feed(api, account_id, account['defaultCategory'], latest_updates, full)
         r = api("/api/v2/account/%s/spaces" % (account_id,))
         for space in r['savingsGoals']:
-            feed(api, account_id, space['savingsGoalUid'])
+            feed(api, account_id, space['savingsGoalUid'], latest_updates, full)
+
+
+def run(api=None, full=False, project_dir=PROJECT_DIR, layout=None, audit=False):
+    audit_changes = None
+    if audit:
+        # Only here: the audit needs python3 and pygit2.
+        import starling.audit
+        audit_changes = starling.audit.audit_changes
+    with fetch_base.fetcher_main(project_dir, write_metrics=True, item_depth=ITEM_DEPTH) as state:
+        if layout is not None:
+            fetch_base.set_layout(state, layout)
+        full = full or fetch_base.full_resync_due(state, FULL_RESYNC_INTERVAL)
+        latest_updates = state.setdefault('latest_updates', {})
+        fetch_base.fetch(lambda: import_starling(latest_updates, full, api), audit_changes)
+        if full:
+            fetch_base.full_resync_done(state)
+    fetch_base.push(project_dir)
+    fetch_base.maintain(project_dir)
 
 
 def main():
-    with fetch_base.fetcher_main("~/projects/starling"):
-        fetch_base.fetch(import_starling)
+    run(full='--full' in sys.argv[1:], layout=fetch_base.layout_arg(),
+        audit='--audit' in sys.argv[1:])
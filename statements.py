@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""Monthly statements for each account, from a bankrepo history.
+
+The banks' own statements can change after the fact; these are made
+from what we recorded instead. Each statement covers one account and
+currency for one calendar month (UTC), with the opening and closing
+balances. Declined transactions are listed but not counted.
+
+The latest version of each transaction is kept in a cache inside the
+git dir, brought up to date from just the new commits, along with each
+month's total and a hash of its transactions, and the statements already
+made for closed months. Only the months touched by new commits are
+summed and hashed again; the opening balances are carried forward from
+the totals. A closed month's statement is only made again if its inputs
+(its transactions and its opening balance) changed, e.g. because of a
+late revision.
+
+Usage: statements.py [--format=text|csv|json] [--month=YYYY-MM | --output=DIR] REPO
+
+With --month, prints that month's statements. With --output, writes
+every month's statements into DIR, as <account>/<currency>-<month>.<format>.
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import hashlib
+import io
+import json
+import os
+import pygit2
+
+import bankrepo
+import ledger
+import lib
+
+
+CACHE_FILE = 'bank-statements.json'
+# Change this when the statement formats change, to make them again.
+CACHE_VERSION = 3
+
+FORMATS = ('text', 'csv', 'json')
+
+
+def _month(record):
+    return datetime.datetime.utcfromtimestamp(record.event_time).strftime('%Y-%m')
+
+
+def _time(record):
+    return datetime.datetime.utcfromtimestamp(record.event_time).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _next_month(month):
+    year, m = map(int, month.split('-'))
+    return '%04d-%02d' % (year + m // 12, m % 12 + 1)
+
+
+Statement = collections.namedtuple('Statement', (
+    'account', 'currency', 'month', 'opening', 'closing', 'records'))
+
+
+def records_hash(records):
+    """Content hash of a month's transactions."""
+    data = json.dumps([list(r) for r in records], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def render_text(statement):
+    currency = statement.currency
+    lines = ['Account %s (%s), %s' % (statement.account, currency, statement.month), '']
+    lines.append('%-19s  %-40s  %12s  %12s' % (
+        '', 'Opening balance', '', lib.pretty_amount(statement.opening, currency)))
+    balance = statement.opening
+    for r in statement.records:
+        counted = ledger.counts_towards_balance(r)
+        if counted:
+            balance += r.minor_units
+        lines.append('%-19s  %-40s  %12s  %12s' % (
+            _time(r), (r.counterparty or '')[:40],
+            lib.pretty_amount(r.minor_units, currency, not counted),
+            lib.pretty_amount(balance, currency)))
+    lines.append('%-19s  %-40s  %12s  %12s' % (
+        '', 'Closing balance', '', lib.pretty_amount(statement.closing, currency)))
+    return '\n'.join(lines) + '\n'
+
+
+def render_csv(statement):
+    """Amounts in minor units, as the banks give them."""
+    f = io.StringIO()
+    w = csv.writer(f)
+    w.writerow(('time', 'id', 'counterparty', 'status', 'amount', 'currency', 'balance'))
+    w.writerow(('', '', 'Opening balance', '', '', statement.currency, statement.opening))
+    balance = statement.opening
+    for r in statement.records:
+        if ledger.counts_towards_balance(r):
+            balance += r.minor_units
+        w.writerow((_time(r), r.id, r.counterparty or '', r.status, r.minor_units, r.currency, balance))
+    w.writerow(('', '', 'Closing balance', '', '', statement.currency, statement.closing))
+    return f.getvalue()
+
+
+def render_json(statement):
+    return json.dumps({
+        'account': statement.account,
+        'currency': statement.currency,
+        'month': statement.month,
+        'opening_balance': statement.opening,
+        'closing_balance': statement.closing,
+        'transactions': [r._asdict() for r in statement.records],
+    }, indent=2, sort_keys=True) + '\n'
+
+
+RENDERERS = {
+    'text': render_text,
+    'csv': render_csv,
+    'json': render_json,
+}
+
+
+class StatementCache(object):
+    """The latest Record of each transaction, and what is made from them.
+
+    records maps each transaction key (account/name) to its Record.
+    months maps account|currency|month to the keys of its records, the
+    total of those counting towards the balance and their records_hash.
+    rendered maps account|currency|month|format to the records_hash and
+    opening balance of a closed month and the statement made from them.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.head = None
+        self.records = {}
+        self.months = {}
+        self.rendered = {}
+
+    @classmethod
+    def load(cls, filename):
+        cache = cls()
+        try:
+            with open(filename) as f:
+                data = json.load(f)
+        except IOError:
+            return cache
+        if data.get('version') != CACHE_VERSION:
+            return cache
+        cache.head = data['head']
+        cache.records = dict((k, ledger.Record(*r)) for k, r in data['records'].items())
+        for month_key, (keys, total, h) in data['months'].items():
+            cache.months[month_key] = [set(keys), total, h]
+        cache.rendered = data['rendered']
+        return cache
+
+    def save(self, filename):
+        with lib.atomic_write(filename) as f:
+            json.dump({
+                'version': CACHE_VERSION,
+                'head': self.head,
+                'records': dict((k, list(r)) for k, r in self.records.items()),
+                'months': dict((k, [sorted(keys), total, h])
+                               for k, (keys, total, h) in self.months.items()),
+                'rendered': self.rendered,
+            }, f, separators=(',', ':'))
+
+    def update(self, repo):
+        """Take in the commits since the last update. Returns how many."""
+        head, commits, rewritten = bankrepo.new_commits(repo, self.head)
+        if rewritten:
+            self.clear()
+        dirty = set()
+        n = 0
+        for commit in commits:
+            for path, old_id, blob_id in bankrepo.changed_files(repo, commit):
+                account = bankrepo.mailbox_dir(path)
+                if not account:
+                    continue
+                payload = json.loads(repo[blob_id].data.decode('utf-8'))
+                key = '%s/%s' % (account, path.rsplit('/', 1)[-1])
+                old = self.records.get(key)
+                if old is not None:
+                    month_key = _month_key(old)
+                    self.months[month_key][0].discard(key)
+                    dirty.add(month_key)
+                record = self.records[key] = ledger.normalize(account, payload)
+                month_key = _month_key(record)
+                self.months.setdefault(month_key, [set(), 0, None])[0].add(key)
+                dirty.add(month_key)
+            n += 1
+        for month_key in dirty:
+            month = self.months[month_key]
+            if not month[0]:
+                del self.months[month_key]
+                continue
+            records = self._records(month[0])
+            month[1] = sum(r.minor_units for r in records if ledger.counts_towards_balance(r))
+            month[2] = records_hash(records)
+        self.head = str(head)
+        return n
+
+    def _records(self, keys):
+        return sorted((self.records[k] for k in keys), key=lambda r: (r.event_time, r.id))
+
+    def statements(self):
+        """Statements for every month of every account and currency, in order.
+
+        Months with no transactions in between others get a statement
+        too, with just the balance carried forward. The records are
+        left as None; see with_records().
+        """
+        by_account = collections.defaultdict(dict)
+        for month_key, month in self.months.items():
+            account, currency, m = month_key.split('|')
+            by_account[(account, currency)][m] = month[1]
+        for (account, currency), totals in sorted(by_account.items()):
+            balance = 0
+            month = min(totals)
+            last = max(totals)
+            while month <= last:
+                closing = balance + totals.get(month, 0)
+                yield Statement(account, currency, month, balance, closing, None)
+                balance = closing
+                month = _next_month(month)
+
+    def with_records(self, statement):
+        month = self.months.get('|'.join((statement.account, statement.currency, statement.month)))
+        return statement._replace(records=self._records(month[0]) if month else [])
+
+    def render(self, statement, fmt, closed_before):
+        """A statement in format fmt, from the cache if its month is
+        before closed_before (YYYY-MM) and its inputs have not changed.
+        """
+        if statement.month >= closed_before:
+            return RENDERERS[fmt](self.with_records(statement))
+        month_key = '|'.join((statement.account, statement.currency, statement.month))
+        month = self.months.get(month_key)
+        inputs = [month[2] if month else None, statement.opening]
+        cached = self.rendered.get(month_key + '|' + fmt)
+        if cached is None or cached[:2] != inputs:
+            cached = self.rendered[month_key + '|' + fmt] = inputs + [
+                RENDERERS[fmt](self.with_records(statement))]
+        return cached[2]
+
+
+def _month_key(record):
+    return '|'.join((record.account, record.currency, _month(record)))
+
+
+def open_cache(repo_path):
+    """The up to date cache for the repo at repo_path, and its filename."""
+    repo = pygit2.Repository(repo_path)
+    filename = os.path.join(repo.path, CACHE_FILE)
+    cache = StatementCache.load(filename)
+    cache.update(repo)
+    return cache, filename
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monthly bank statements.')
+    parser.add_argument('--format', choices=FORMATS, default='text')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--month', help='print the statements for this month, e.g. 2021-03')
+    group.add_argument('--output', help='write the statements for every month into this directory')
+    parser.add_argument('repo')
+    args = parser.parse_args()
+
+    cache, filename = open_cache(os.path.expanduser(args.repo))
+    closed_before = datetime.datetime.utcnow().strftime('%Y-%m')
+    for statement in cache.statements():
+        if args.month is not None:
+            if statement.month == args.month:
+                print(cache.render(statement, args.format, closed_before))
+            continue
+        fn = os.path.join(args.output, statement.account, '%s-%s.%s' % (
+            statement.currency, statement.month, args.format))
+        text = cache.render(statement, args.format, closed_before)
+        try:
+            with io.open(fn, encoding='utf-8') as f:
+                if f.read() == text:
+                    continue
+        except IOError:
+            pass
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        with io.open(fn, 'w', encoding='utf-8') as f:
+            f.write(text)
+    cache.save(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,16 +10,31 @@
 import base64
 import datetime
 import errno
-import json
 import os
 import re
-import subprocess
+import sys
 import yaml
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 from Crypto.Signature import PKCS1_v1_5
 
 import fetch_base
+import lib
+
+
+PROJECT_DIR = "~/projects/wise"
+
+# Items are committed as <account>/<currency>/<reference number>.
+ITEM_DEPTH = 3
+
+# https://api-docs.transferwise.com/#borderless-accounts-get-account-statement
+# "The period between intervalStart and intervalEnd cannot exceed 469 days"
+# But empirically, we get a 400 if it exceeds ~450 days.
+MAX_INTERVAL = datetime.timedelta(days=450)
+
+# Routine runs refetch from this long before the end of what we
+# already have, to pick up late changes to recent transactions.
+RECENT_OVERLAP = datetime.timedelta(days=7)
 
 
 class WiseAPI(fetch_base.BankAPI):
@@ -40,25 +55,15 @@ class WiseAPI(fetch_base.BankAPI):
         return base64.b64encode(signature)
 
 
-def statement(api, account_id, currency):
-    try:
-        os.mkdir(os.path.join(str(account_id), currency))
-    except FileExistsError:
-        pass
-    if not currency.isalpha():
-        raise RuntimeError('Unsafe currency ' + currency)
-    now = datetime.datetime.utcnow()
-    end = now
-    # https://api-docs.transferwise.com/#borderless-accounts-get-account-statement
-    # "The period between intervalStart and intervalEnd cannot exceed 469 days"
-    # But empirically, we get a 400 if it exceeds ~450 days.
-    start = end - datetime.timedelta(days=450)
-    r = api("/v3/profiles/%s/borderless-accounts/%s/statement.json?"
-            "currency=%s&intervalStart=%sZ&intervalEnd=%sZ&type=COMPACT" % (
-                api.profile, account_id, currency, start.isoformat(), end.isoformat()
-            )
-    )
-    for transaction in r['transactions']:
+def statement(api, account_id, currency, start, end):
+    transactions = api.stream(
+        "/v3/profiles/%s/borderless-accounts/%s/statement.json?"
+        "currency=%s&intervalStart=%s&intervalEnd=%s&type=COMPACT" % (
+            api.profile, account_id, currency, lib.format_iso8601(start), lib.format_iso8601(end)
+        ), 'transactions')
+    count = 0
+    for transaction in transactions:
+        count += 1
         try:
             # This field makes entries order-dependent and not self-contained.
             del transaction['runningBalance']
@@ -67,14 +72,52 @@ def statement(api, account_id, currency):
         ref = transaction['referenceNumber']
         if ref.startswith('.') or '/' in ref:
             raise RuntimeError('Unsafe referenceNumber ' + ref)
-        fn = "%d/%s/%s" % (account_id, currency, ref)
-        with open(fn, "w") as f:
-            json.dump(transaction, f, indent=2, sort_keys=True)
-        subprocess.check_call(('git', 'add', fn))
+        fn = fetch_base.item_path("%d/%s" % (account_id, currency), ref)
+        fetch_base.stage(fn, transaction)
+    return count
 
 
-def import_wise():
-    api = WiseAPI()
+def sync_currency(api, account_id, currency, coverage, backfill=False):
+    """Fetch statements for one currency and extend its coverage.
+
+    coverage is a dict with 'start' and 'end' of the interval that
+    has been fetched so far. It is updated in place.
+
+    Normally only the interval since the end of the coverage (minus
+    RECENT_OVERLAP) is fetched, in chunks of at most MAX_INTERVAL.
+    With backfill, also go back in time one chunk at a time from the
+    start of the coverage until a chunk comes back empty.
+    """
+    if not currency.isalpha():
+        raise RuntimeError('Unsafe currency ' + currency)
+    try:
+        os.mkdir(os.path.join(str(account_id), currency))
+    except FileExistsError:
+        pass
+    now = datetime.datetime.utcnow()
+    if 'end' in coverage:
+        start = lib.parse_iso8601(coverage['end']) - RECENT_OVERLAP
+    else:
+        start = now - MAX_INTERVAL
+    while start < now:
+        end = min(start + MAX_INTERVAL, now)
+        statement(api, account_id, currency, start, end)
+        if 'start' not in coverage:
+            coverage['start'] = lib.format_iso8601(start)
+        coverage['end'] = lib.format_iso8601(end)
+        start = end
+    if backfill:
+        while True:
+            end = lib.parse_iso8601(coverage['start'])
+            start = end - MAX_INTERVAL
+            if statement(api, account_id, currency, start, end) == 0:
+                break
+            coverage['start'] = lib.format_iso8601(start)
+
+
+def import_wise(coverage, backfill=False, api=None):
+    if api is None:
+        api = WiseAPI()
     r = api("/v1/borderless-accounts?profileId=" + str(api.profile))
     for account in r:
         account_id = int(account['id'])
@@ -83,8 +126,20 @@ def import_wise():
         except FileExistsError:
             pass
         for balance in account['balances']:
-            statement(api, account_id, balance['currency'])
+            currency = balance['currency']
+            sync_currency(
+                api, account_id, currency,
+                coverage.setdefault("%d/%s" % (account_id, currency), {}),
+                backfill)
+
+def run(api=None, backfill=False, project_dir=PROJECT_DIR, layout=None):
+    with fetch_base.fetcher_main(project_dir, write_metrics=True, item_depth=ITEM_DEPTH) as state:
+        if layout is not None:
+            fetch_base.set_layout(state, layout)
+        fetch_base.fetch(lambda: import_wise(
+            state.setdefault('coverage', {}), backfill, api))
+    fetch_base.push(project_dir)
+    fetch_base.maintain(project_dir)
 
 def main():
-    with fetch_base.fetcher_main("~/projects/wise"):
-        fetch_base.fetch(import_wise)
+    run(backfill='--backfill' in sys.argv[1:], layout=fetch_base.layout_arg())